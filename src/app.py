@@ -1,20 +1,42 @@
-from flask import Flask, render_template, request
+from flask import Flask, Response, abort, g, render_template, request, stream_with_context
 from flask_cors import CORS
 import numpy as np
 import json
+import time
 import sys
 sys.path.append('./')
 sys.path.append('./static/dataset/')
-from data_utils import get_prediction, PoseTrack_Keypoint_Pairs
-from ui_utils import get_dataset_subset, check_assertions
+from data_utils import get_prediction, PoseTrack_Keypoint_Pairs, PoseTrack_COCO_Keypoint_Ordering, FPS
+from dataset_registry import DatasetRegistry, MAX_LOADED_BYTES
+from ui_utils import get_dataset_subset, iter_dataset_subset, iter_assertion_errors
+from thumbnails import ThumbnailCache, THUMB_CACHE_MAX_BYTES, thumbnail_key, get_thumbnail
+from dsl import compile_assertions, DslError
+from metrics import RequestTimer, collector, current_timer, stage
+from error_store import ErrorStore, ERROR_QUERY_LIMIT
+from result_cache import ResultCache, ResultSet, MaskCache, PAGE_SIZE, make_cursor, parse_cursor
 from matplotlib import colors
 
 
-FILENAME = 'SNMOT-061'
+DEFAULT_DATASET = 'SNMOT-061'
 FILE_EXTENSION = '.jpg'
-DATASET_PATH = './static/dataset/' + FILENAME + '/'
+DATASETS_PATH = './static/dataset/'
+CHECK_WORKERS = 1 # processes used to check assertions, >1 starts a process pool for long videos
 
-dataset_json = json.load(open(DATASET_PATH + FILENAME + '.pose.json', 'r'))
+THUMB_CACHE_PATH = './.thumb_cache/'
+THUMB_MAX_AGE = 24*3600
+ERROR_STORE_PATH = None # SQLite history of the checks (e.g. './errors.sqlite'), disabled when None
+
+# Skeleton drawn over the thumbnails: keypoint ids of every pair and its color
+KEYPOINT_PAIRS = np.array([[PoseTrack_COCO_Keypoint_Ordering.index(a), PoseTrack_COCO_Keypoint_Ordering.index(b)]
+                           for a, b, _ in PoseTrack_Keypoint_Pairs])
+KEYPOINT_PAIR_COLORS = [np.round(colors.to_rgba(c), 2).tolist() for _, _, c in PoseTrack_Keypoint_Pairs]
+
+registry = DatasetRegistry(DATASETS_PATH, MAX_LOADED_BYTES)
+thumb_cache = ThumbnailCache(THUMB_CACHE_PATH, THUMB_CACHE_MAX_BYTES)
+result_cache = ResultCache()
+mask_cache = MaskCache()
+registry.add_unload_listener(lambda name: result_cache.invalidate(name))
+error_store = ErrorStore(ERROR_STORE_PATH) if ERROR_STORE_PATH else None
 
 app = Flask(__name__,static_folder='static',template_folder='templates')
 CORS(app)
@@ -23,142 +45,373 @@ import logging
 log = logging.getLogger('werkzeug')
 log.setLevel(logging.ERROR)
 
+@app.before_request
+def start_timer():
+  g.timer = RequestTimer(request.endpoint or 'unknown')
+  current_timer.set(g.timer)
+
+@app.after_request
+def add_server_timing(response):
+  timer = g.get('timer')
+  if timer is not None:
+    response.headers['Server-Timing'] = timer.server_timing()
+    if not g.get('streamed'):
+      timer.finish()
+  return response
+
+@app.teardown_request
+def stop_timer(exc):
+  current_timer.set(None)
+
+@app.route('/metrics')
+def metrics():
+  return Response(collector.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/')
 def index():
   return render_template('index.html')
 
+@app.route('/datasets')
+def datasets():
+  data_ = {"datasets": registry.discover(), "default": DEFAULT_DATASET, "cache": registry.stats(), "masks": mask_cache.stats()}
+  return json.dumps(data_)
+
+@app.route('/thumb/<name>/<int:frame>/<int:person>')
+def thumb(name, frame, person):
+  if not registry.exists(name):
+    abort(404)
+  pred = get_prediction(registry.get(name), frame, person)
+  if pred is None:
+    abort(404)
+
+  skeleton = request.args.get('skeleton', '1') != '0'
+  key = thumbnail_key(thumb_cache, name, registry.path(name), pred, FILE_EXTENSION, skeleton)
+  if key is None:
+    abort(404)
+
+  if request.if_none_match.contains(key):
+    resp = Response(status=304)
+  else:
+    data = get_thumbnail(thumb_cache, key, registry.path(name), pred, FILE_EXTENSION, skeleton)
+    resp = Response(data, mimetype='image/jpeg')
+  resp.set_etag(key)
+  resp.cache_control.public = True
+  resp.cache_control.max_age = THUMB_MAX_AGE
+  return resp
+
+def get_dataset(content):
+  name = content.get('dataset') or DEFAULT_DATASET
+  if not registry.exists(name):
+    return name, None
+  with stage('dataset'):
+    return name, registry.get(name)
+
+def dumps(data):
+  with stage('serialize'):
+    return json.dumps(data)
+
 @app.route('/search', methods = ['POST'])
 def search():
   content = request.get_json(silent=True)
-  res = get_dataset_subset(dataset_json, DATASET_PATH + FILENAME,
-          content['checkbox'],int(content['batches']),int(content['frames']), False)
+  if content.get('cursor'):
+    return dumps(next_page(content))
 
-  frames_ = []
-  keypoints_ = []
-  bbox_ = []
-  asst_ = []
+  data_ = {"error": True, "images": [], "keypoints": [], "bbox": []}
 
-  if res == None or len(res) == 0:
-    data_ = {"error": True, "images": [], "keypoints": [], "bbox": []}
-    return json.dumps(data_)
+  name, dataset = get_dataset(content)
+  if dataset is None:
+    return reply(content, data_)
 
-  for b in range(len(res)):
-    for f in range(res[b].length()):
-      frame_num = res[b].get_frame_at(f).get_prediction().get_real_frame_number()
-      keypoints = res[b].get_frame_at(f).get_prediction().get_keypoints()
-      bbox = res[b].get_frame_at(f).get_prediction().get_bbox()
-      person = res[b].get_frame_at(f).get_prediction().get_person()
-
-      frame_num_rel = res[b].get_frame_at(f).get_prediction().get_relative_frame_number()
-
-      pred_1 = get_prediction(dataset_json, max(0,frame_num_rel - 1), person)
-      if pred_1 == None:
-        pred_1 = res[b].get_frame_at(f).get_prediction()
-      keypoints_1 = pred_1.get_keypoints()
-      bbox_1 = pred_1.get_bbox()
-      prev = pred_1.get_real_frame_number()
-
-      pred_3 = get_prediction(dataset_json, min(len(dataset_json['person'])-1,frame_num_rel + 1), person)
-      if pred_3 == None:
-        pred_3 = res[b].get_frame_at(f).get_prediction()
-      keypoints_3 = pred_3.get_keypoints()
-      bbox_3 = pred_3.get_bbox()
-      next = pred_3.get_real_frame_number()
-
-      frames_.append([formated_frame(prev+1), formated_frame(frame_num+1), formated_frame(next + 1)])
-      keypoints_.append([formated_keypoints(keypoints_1, bbox_1),
-                        formated_keypoints(keypoints, bbox), 
-                        formated_keypoints(keypoints_3, bbox_3)])
-      bbox_.append([bbox_1, bbox, bbox_3])
-      asst_.append('')
-
-  data_ = {"error": False, "images": frames_, "keypoints": keypoints_, "bbox": bbox_, "asst_names": asst_}
-  return json.dumps(data_)
+  key = result_cache.key('search', name, content['checkbox'], int(content['batches']), int(content['frames']))
+  if is_streamed(content):
+    return stream_response(content, stream_search(content, name, dataset, key))
 
-def formated_frame(frame_num):
-  return FILENAME + '/frames/thumb' + str(frame_num).zfill(4) + FILE_EXTENSION
+  result = result_cache.get(key, dataset)
+  if result is None:
+    try:
+      res = get_dataset_subset(dataset, registry.path(name),
+              content['checkbox'],int(content['batches']),int(content['frames']), False)
+    except RuntimeError as e:
+      data_["message"] = str(e)
+      return json.dumps(data_)
 
-def formated_keypoints(keypoints, bbox):
-  x,y,_,_ = list(map(int, bbox))
-  kp_plot = []
-  for joint_pair in PoseTrack_Keypoint_Pairs:
-    ind_1, ind_2, color = joint_pair
-    x1, y1 = keypoints[ind_1].position()
-    x2, y2 = keypoints[ind_2].position()
+    if res == None or len(res) == 0:
+      return json.dumps(data_)
 
-    kp_plot.append((int(x1-x), int(y1-y), int(x2-x), int(y2-y), np.round(colors.to_rgba(color),2).tolist()))
-  return kp_plot
+    idx = [f.get_prediction().get_index() for b in res for f in b.get_frames()]
+    result = ResultSet(key, name, dataset, idx, [''] * len(idx))
+    result_cache.put(result)
+
+  return dumps(results_page(dataset, result, 0, page_size(content)))
+
+def page_size(content):
+  return max(1, int(content.get('page_size') or PAGE_SIZE))
+
+def next_page(content):
+  key, offset = parse_cursor(content['cursor'])
+  result = result_cache.get(key) if key else None
+  dataset = result.store() if result is not None else None
+  if dataset is None:
+    return {"error": True, "expired": True, "images": [], "keypoints": [], "bbox": []}
+
+  # Pages are always read from the store the ids were computed on
+  return results_page(dataset, result, offset, page_size(content))
+
+def results_page(dataset, result, offset, size):
+  idx, labels = result.page(offset, size)
+  data_ = result_rows(result.dataset(), dataset, idx, labels)
+  data_.update({"error" : False, "cursor": make_cursor(result, offset + len(idx)),
+                "total": result.length(), "counts": result.counts()})
+  return data_
+
+def result_rows(name, dataset, idx, labels):
+  with stage('rows', len(idx)):
+    return triplets(name, dataset, idx, labels)
+
+def triplets(name, dataset, idx, labels):
+  # Previous, current and next prediction of every row, gathered from the store's neighbor
+  # index. A missing neighbor is replaced by the prediction itself.
+  idx = np.asarray(idx, dtype=np.int64)
+  prev = dataset.prev_index()[idx]
+  next = dataset.next_index()[idx]
+  strip = np.stack([np.where(prev < 0, idx, prev), idx, np.where(next < 0, idx, next)], axis=1)
+
+  ids = strip.ravel()
+  frames = dataset.pred_frame_[ids]
+  real_frames = dataset.frame_numbers_[frames].reshape(strip.shape).tolist()
+  relative = frames.reshape(strip.shape).tolist()
+  persons = dataset.pred_person_[ids].reshape(strip.shape).tolist()
+  bboxes = dataset.bboxes_[ids].reshape(strip.shape + (4,))
+  segments = formated_keypoints(dataset.keypoints_[ids], dataset.bboxes_[ids]).reshape(strip.shape + (-1, 4)).tolist()
+
+  frames_ = [[formated_frame(name, f + 1) for f in row] for row in real_frames]
+  thumbs_ = [[formated_thumb(name, f, p) for f, p in zip(*row)] for row in zip(relative, persons)]
+  keypoints_ = [[[s + [c] for s, c in zip(segs, KEYPOINT_PAIR_COLORS)] for segs in row] for row in segments]
+
+  return {"images": frames_, "thumbs": thumbs_, "keypoints": keypoints_, "bbox": bboxes.tolist(), "asst_names": list(labels)}
+
+def is_streamed(content):
+  return bool(content.get('stream'))
+
+def reply(content, data):
+  # Early answers (bad request, unknown dataset, ...) keep the format the client asked for
+  if is_streamed(content):
+    return stream_response(content, iter([dict(data, event="summary")]))
+  return json.dumps(data)
+
+def stream_response(content, events):
+  # NDJSON by default, server-sent events with {"stream": "sse"} or Accept: text/event-stream
+  sse = content.get('stream') == 'sse' or 'text/event-stream' in request.headers.get('Accept', '')
+
+  # The events are produced after the request returned, so the stages are timed here and
+  # the summary carries them instead of the Server-Timing header
+  timer = g.timer
+  g.streamed = True
+
+  def generate():
+    try:
+      with timer.activate():
+        for event in events:
+          if event['event'] == 'summary':
+            event['timings'] = timer.timings()
+          data = dumps(event)
+          yield 'event: ' + event['event'] + '\ndata: ' + data + '\n\n' if sse else data + '\n'
+    finally:
+      timer.finish()
+
+  headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+  return Response(stream_with_context(generate()), mimetype='text/event-stream' if sse else 'application/x-ndjson', headers=headers)
+
+def stream_rows(name, dataset, idx, labels, sent, limit):
+  # Rows event for the part of a chunk that fits under the limit, None once it is reached
+  n = max(0, min(len(idx), limit - sent))
+  if n == 0:
+    return None
+  data_ = result_rows(name, dataset, idx[:n], labels[:n])
+  data_.update({"event": "rows", "offset": sent})
+  return data_
+
+def stream_summary(result, sent, start):
+  return {"event": "summary", "error": False, "total": result.length(), "counts": result.counts(),
+          "cursor": make_cursor(result, sent), "seconds": round(time.time() - start, 3)}
+
+def stream_cached(dataset, result, limit, start):
+  idx, labels = result.page(0, limit)
+  if len(idx):
+    yield stream_rows(result.dataset(), dataset, idx, labels, 0, limit)
+  yield stream_summary(result, len(idx), start)
+
+def stream_search(content, name, dataset, key):
+  # Every batch is sent as soon as Predicate.run produces it. Rows beyond page_size (all
+  # of them if not given) are only kept in the result set, for the cursor of the summary.
+  start = time.time()
+  limit = page_size(content) if content.get('page_size') else sys.maxsize
+  result = result_cache.get(key, dataset)
+  if result is not None:
+    yield from stream_cached(dataset, result, limit, start)
+    return
+
+  idx = []
+  try:
+    for b in iter_dataset_subset(dataset, registry.path(name),
+            content['checkbox'],int(content['batches']),int(content['frames']), False):
+      batch_idx = [f.get_prediction().get_index() for f in b.get_frames()]
+      rows = stream_rows(name, dataset, batch_idx, [''] * len(batch_idx), len(idx), limit)
+      if rows is not None:
+        yield rows
+      idx.extend(batch_idx)
+  except RuntimeError as e:
+    yield {"event": "summary", "error": True, "message": str(e), "total": len(idx), "counts": {}, "cursor": None}
+    return
+
+  if len(idx) == 0:
+    yield {"event": "summary", "error": True, "total": 0, "counts": {}, "cursor": None}
+    return
+
+  result = ResultSet(key, name, dataset, idx, [''] * len(idx))
+  result_cache.put(result)
+  yield stream_summary(result, min(len(idx), limit), start)
+
+def stream_check(content, name, dataset, key, assertions):
+  # Errors are sent chunk by chunk while the rest of the video is still being checked
+  start = time.time()
+  limit = page_size(content) if content.get('page_size') else sys.maxsize
+  result = result_cache.get(key, dataset)
+  if result is not None:
+    yield from stream_cached(dataset, result, limit, start)
+    return
+
+  idx = []
+  labels = []
+  try:
+    res = get_dataset_subset(dataset, registry.path(name), content['checkbox'],0,0, False) or []
+    for chunk_idx, chunk_labels in iter_assertion_errors(dataset, res, assertions, CHECK_WORKERS, mask_cache, (name, content['checkbox'])):
+      rows = stream_rows(name, dataset, chunk_idx, chunk_labels, len(idx), limit)
+      if rows is not None:
+        yield rows
+      idx.extend(chunk_idx.tolist())
+      labels.extend(chunk_labels)
+  except RuntimeError as e:
+    yield {"event": "summary", "error": True, "message": str(e), "total": len(idx), "counts": {}, "cursor": None}
+    return
+
+  result = ResultSet(key, name, dataset, idx, labels)
+  result_cache.put(result)
+  record_errors(dataset, result, assertions, content['checkbox'])
+  yield stream_summary(result, min(len(idx), limit), start)
+
+def record_errors(dataset, result, assertions, checkbox):
+  # Every computed check is a run of the error store; cached results were already recorded
+  if error_store is None:
+    return
+  with stage('error_store', result.length()):
+    idx, labels = result.page(0, result.length())
+    frames = dataset.pred_frame_[idx]
+    error_store.add_run(result.dataset(), assertions, checkbox, labels, dataset.frame_numbers_[frames], frames,
+                        dataset.pred_track_[idx], dataset.pred_person_[idx])
+
+def error_filter(args):
+  # Query string of /errors and /errors/summary -> filter of the error store. Times in
+  # seconds are converted into frames.
+  name = args.get('dataset') or DEFAULT_DATASET
+  run = args.get('run', type=int) or error_store.latest_run(name)
+  frame_min = args.get('frame_min', type=int)
+  frame_max = args.get('frame_max', type=int)
+  if args.get('seconds_min', type=float) is not None:
+    frame_min = int(args.get('seconds_min', type=float) * FPS)
+  if args.get('seconds_max', type=float) is not None:
+    frame_max = int(args.get('seconds_max', type=float) * FPS)
+  return name, run, {'assertion': args.get('assertion'), 'person': args.get('person', type=int),
+                     'frame_min': frame_min, 'frame_max': frame_max}
+
+@app.route('/errors')
+def errors():
+  if error_store is None:
+    abort(404)
+  name, run, filter_ = error_filter(request.args)
+  if run is None:
+    return json.dumps({"error": True, "message": "No runs recorded for " + name})
+
+  limit = request.args.get('limit', ERROR_QUERY_LIMIT, type=int)
+  offset = request.args.get('offset', 0, type=int)
+  rows, total = error_store.query(name, run, limit=limit, offset=offset, **filter_)
+  return json.dumps({"error": False, "dataset": name, "run": run, "total": total, "rows": rows})
+
+@app.route('/errors/summary')
+def errors_summary():
+  if error_store is None:
+    abort(404)
+  name, run, filter_ = error_filter(request.args)
+  if run is None:
+    return json.dumps({"error": True, "message": "No runs recorded for " + name})
+
+  group = request.args.get('group', 'assertion').split(',')
+  try:
+    groups = error_store.summary(name, run, group, limit=request.args.get('limit', ERROR_QUERY_LIMIT, type=int), **filter_)
+  except RuntimeError as e:
+    return json.dumps({"error": True, "message": str(e)})
+  return json.dumps({"error": False, "dataset": name, "run": run, "groups": groups})
+
+@app.route('/errors/runs')
+def errors_runs():
+  if error_store is None:
+    abort(404)
+  return json.dumps({"error": False, "runs": error_store.runs(request.args.get('dataset'))})
+
+def formated_frame(name, frame_num):
+  return name + '/frames/thumb' + str(frame_num).zfill(4) + FILE_EXTENSION
+
+def formated_thumb(name, frame, person):
+  return '/thumb/' + name + '/' + str(frame) + '/' + str(person)
+
+def formated_keypoints(keypoints, bboxes):
+  # (n, pairs, 4) skeleton segments x1, y1, x2, y2 relative to the top left corner of the bbox
+  origin = bboxes[:, None, :2].astype(np.int64)
+  start = keypoints[:, KEYPOINT_PAIRS[:, 0], :2].astype(np.float64) - origin
+  end = keypoints[:, KEYPOINT_PAIRS[:, 1], :2].astype(np.float64) - origin
+  return np.concatenate([start, end], axis=2).astype(np.int64)
 
 @app.route('/check', methods = ['POST'])
 def check():
   content = request.get_json(silent=True)
-  assertions = []
+  if content.get('cursor'):
+    return dumps(next_page(content))
+
   data_ = {"error": True, "images": [], "keypoints": [], "bbox": []}
 
-  if not content["assertions"] or content["assertions"][0] != '[' or content["assertions"][-1] != ']':
-    return json.dumps(data_)
+  name, dataset = get_dataset(content)
+  if dataset is None:
+    return reply(content, data_)
 
-  asst = content['assertions'][1:].replace("}]","},").replace("'",'"').split("},")[:-1]
-  if len(asst) == 0 or asst[0] == "{":
-    return json.dumps(data_)
+  try:
+    assertions = [fn.to_dict() for fn in compile_assertions(content.get('assertions') or '')]
+  except DslError as e:
+    data_.update(e.to_dict())
+    return reply(content, data_)
+
+  key = result_cache.key('check', name, assertions, content['checkbox'])
+  if is_streamed(content):
+    return stream_response(content, stream_check(content, name, dataset, key, assertions))
 
-  for a in asst:
-    a = a + "}"
+  result = result_cache.get(key, dataset)
+  if result is None:
+    idx = []
+    labels = []
     try:
-      j = json.loads(a)
-      assertions.append(j)
-    except Exception as e:
-      print(e)
-      print("Error in ", a)
-      data_ = {"error": True, "images": [], "keypoints": [], "bbox": []}
+      res = get_dataset_subset(dataset, registry.path(name),
+              content['checkbox'],0,0, False) or []
+      for chunk_idx, chunk_labels in iter_assertion_errors(dataset, res, assertions, CHECK_WORKERS, mask_cache, (name, content['checkbox'])):
+        idx.extend(chunk_idx.tolist())
+        labels.extend(chunk_labels)
+    except RuntimeError as e:
+      data_["message"] = str(e)
       return json.dumps(data_)
+    result = ResultSet(key, name, dataset, idx, labels)
+    result_cache.put(result)
+    record_errors(dataset, result, assertions, content['checkbox'])
 
-  res = get_dataset_subset(dataset_json, DATASET_PATH + FILENAME,
-          content['checkbox'],0,0, False)
-
-  errors, _ = check_assertions(DATASET_PATH + FILENAME, dataset_json, res, assertions, False)
-
-  #errors.to_csv('errors.csv', index=False)
-
-  if errors is None:
+  if result.length() == 0:
     data_ = {"error": False, "images": [], "keypoints": [], "bbox": []}
     return json.dumps(data_)
 
-  frames_ = []
-  keypoints_ = []
-  bbox_ = []
-  asst_ = []
-
-  fn = errors['relative_frame_number'].tolist()
-  pl = errors['person'].tolist()
-  asst = errors['assertion'].tolist()
-
-  for ii, f in enumerate(fn):
-    frame = get_prediction(dataset_json, f, pl[ii])
-    keypoints = frame.get_keypoints()
-    bbox = frame.get_bbox()
-    person = frame.get_person()
-
-    pred_1 = get_prediction(dataset_json, max(0,f - 1), person)
-    if pred_1 == None:
-      pred_1 = frame
-    keypoints_1 = pred_1.get_keypoints()
-    bbox_1 = pred_1.get_bbox()
-    prev = pred_1.get_real_frame_number()
-
-    pred_3 = get_prediction(dataset_json, min(len(dataset_json['person'])-1,f + 1), person)
-    if pred_3 == None:
-      pred_3 = frame
-    keypoints_3 = pred_3.get_keypoints()
-    bbox_3 = pred_3.get_bbox()
-    next = pred_3.get_real_frame_number()
-
-    frames_.append([formated_frame(prev+1), formated_frame(frame.get_real_frame_number()+1), formated_frame(next + 1)])
-    keypoints_.append([formated_keypoints(keypoints_1, bbox_1),
-                      formated_keypoints(keypoints, bbox), 
-                      formated_keypoints(keypoints_3, bbox_3)])
-    bbox_.append([bbox_1, bbox, bbox_3])
-    asst_.append(asst[ii])
-
-  data_ = {"error" : False, "images": frames_, "keypoints": keypoints_, "bbox": bbox_, "asst_names": asst_}
-  return json.dumps(data_)
\ No newline at end of file
+  return dumps(results_page(dataset, result, 0, page_size(content)))
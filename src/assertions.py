@@ -1,8 +1,21 @@
 import pandas as pd
 from enum import Enum
-from scipy.spatial import distance
 import numpy as np
-from data_utils import Prediction, PoseTrack_COCO_Keypoint_Ordering, get_prediction
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from data_utils import Prediction, PoseStore, GrowableArray, PoseTrack_COCO_Keypoint_Ordering
+from metrics import stage
+
+TEMPORAL_WINDOW = (2, 1) # real frames observed before and after a prediction by temporal assertions
+SHARD_MIN_PREDICTIONS = 20000 # below this size a single process is faster than the pool
+SHARDS_PER_WORKER = 4
+POOL_START_METHOD = 'spawn' # workers never fork the threads of the server that starts the pool
+STREAM_FIRST_CHUNK = 2000 # predictions in the first chunk of a streamed check, later chunks double
+STREAM_MAX_CHUNK = 1 << 17
+
+process_pool = None
+process_pool_workers = 0
+shard_stores = {} # dataset caches opened by this worker process, by folder
 
 class PositionCondition(Enum):
   ABOVE = "above"
@@ -61,6 +74,9 @@ class AssertionFunction:
   def attributes(self) -> 'list':
     return self.attributes_
 
+  def to_dict(self) -> dict:
+    return {'keypoints': self.keypoints_, 'type': self.type_, 'attributes': self.attributes_}
+
 class Assertion:
   def __init__(self, fn: AssertionFunction) -> None:
     self.name_ = None
@@ -78,37 +94,163 @@ class Assertion:
   def set_function(self, fn: AssertionFunction) -> None:
     self.fn_ = fn
 
-class LabellingError:
-  def __init__(self, assertion: Assertion, prediction: Prediction, pred_idx: int):
-    self.assertion_ = assertion
-    self.prediction_ = prediction
-    self.pred_idx_ = pred_idx
-
-  def get_prediction(self) -> Prediction:
-    return self.prediction_
-
-  def get_prediction_indx(self) -> Prediction:
-    return self.pred_idx_
-
-  def get_assertion(self) -> Assertion:
-    return self.assertion_
-
-  def get_data_as_df(self) -> pd.DataFrame:
-    d = {"assertion" : self.assertion_.name()}
-    for k,v in self.prediction_.get_keypoints().items():
-      d[k] = '(' + str(v.position()[0]) + ',' + str(v.position()[1]) + ')'
-    d['frame_number'] = self.prediction_.get_real_frame_number()
-    d['relative_frame_number'] = self.prediction_.get_relative_frame_number()
-    d['prediction_idx'] = self.get_prediction_indx()
-    d['person'] = self.prediction_.get_person()
-
-    return pd.DataFrame(d, index=[0])
+class ErrorTable:
+  # Errors accumulated column by column: the assertion that fired, the position of the
+  # prediction in the checked input and its id in the store. Frames, persons, tracks and keypoints
+  # are gathered from the store in one pass when the table is converted to a DataFrame.
+  def __init__(self, store: PoseStore) -> None:
+    self.store_ = store
+    self.clear()
+
+  def clear(self) -> None:
+    self.assertions_ = []
+    self.assertion_ids_ = GrowableArray((), np.int32)
+    self.pred_idx_ = GrowableArray((), np.int64)
+    self.store_idx_ = GrowableArray((), np.int64)
+
+  def append(self, assertion: str, pred_idx: np.ndarray, store_idx: np.ndarray) -> None:
+    if assertion not in self.assertions_:
+      self.assertions_.append(assertion)
+    self.assertion_ids_.append(np.full(len(pred_idx), self.assertions_.index(assertion), dtype=np.int32))
+    self.pred_idx_.append(pred_idx)
+    self.store_idx_.append(store_idx)
+
+  def length(self) -> int:
+    return self.pred_idx_.length()
+
+  def to_df(self) -> pd.DataFrame:
+    idx = self.store_idx_.array()
+    frames = self.store_.pred_frame_[idx]
+    positions = self.store_.keypoints_[idx, :, :2].astype(np.float64)
+
+    d = {'assertion': np.array(self.assertions_, dtype=object)[self.assertion_ids_.array()]}
+    for j, kp in enumerate(PoseTrack_COCO_Keypoint_Ordering):
+      d[kp + '_x'] = positions[:, j, 0]
+      d[kp + '_y'] = positions[:, j, 1]
+    d['frame_number'] = self.store_.frame_numbers_[frames]
+    d['relative_frame_number'] = frames
+    d['prediction_idx'] = self.pred_idx_.array()
+    d['person'] = self.store_.pred_person_[idx]
+    d['track'] = self.store_.pred_track_[idx]
+
+    return pd.DataFrame(d)
+
+def chain_conditions(hits: np.ndarray, ties: np.ndarray) -> np.ndarray:
+  # Conditions are chained as an implication: a prediction is an error when every
+  # condition but the last one holds and the last one does not. A condition that
+  # falls within the margin (tie) invalidates the whole chain.
+  prefix = np.cumprod(hits, axis=1).sum(axis=1)
+  return (prefix == hits.shape[1] - 1) & ~np.any(ties & ~hits, axis=1)
+
+def keypoint_pairs(fn: AssertionFunction) -> 'list[tuple[int,int]]':
+  kp_ids = [PoseTrack_COCO_Keypoint_Ordering.index(kp) for kp in fn.keypoints()]
+  return list(zip(kp_ids[0::2], kp_ids[1::2]))
+
+class SharedFeatures:
+  # Keypoint features of the predictions in idx, computed at most once per evaluation and
+  # shared by every assertion that uses them: dx/dy and distance per keypoint pair for
+  # spatial assertions, window neighbors and displacement per keypoint for temporal ones.
+  def __init__(self, store: PoseStore, idx: np.ndarray, temporal_window: 'tuple[int,int]') -> None:
+    self.store_ = store
+    self.idx_ = idx
+    self.temporal_window_ = temporal_window
+    self.diffs_ = {}
+    self.distances_ = {}
+    self.neighbors_ = {}
+    self.displacements_ = {}
+
+  def plan(self, assertions: 'list[Assertion]') -> None:
+    # All the pairs of the spatial assertions are gathered in a single pass over the keypoints
+    pairs = set()
+    for asst in assertions:
+      fn = asst.function()
+      if fn.type() == 'spatial' and all(kp in PoseTrack_COCO_Keypoint_Ordering for kp in fn.keypoints()):
+        pairs.update(keypoint_pairs(fn))
+    self.__compute_diffs([p for p in pairs if p not in self.diffs_])
+
+  def __compute_diffs(self, pairs: 'list[tuple[int,int]]') -> None:
+    if not pairs:
+      return
+    kps = sorted({kp for p in pairs for kp in p})
+    col = {kp: j for j, kp in enumerate(kps)}
+    positions = self.store_.keypoints_[self.idx_[:, None], np.array(kps)[None, :], :2].astype(np.float64)
+    diff = positions[:, [col[a] for a, _ in pairs]] - positions[:, [col[b] for _, b in pairs]]
+    for j, p in enumerate(pairs):
+      self.diffs_[p] = diff[:, j]
+
+  def diffs(self, pairs: 'list[tuple[int,int]]') -> np.ndarray:
+    # (len(idx), len(pairs), 2): first keypoint minus second keypoint of every pair
+    self.__compute_diffs(list(dict.fromkeys(p for p in pairs if p not in self.diffs_)))
+    return np.stack([self.diffs_[p] for p in pairs], axis=1).reshape(len(self.idx_), len(pairs), 2)
+
+  def distances(self, pairs: 'list[tuple[int,int]]') -> np.ndarray:
+    missing = list(dict.fromkeys(p for p in pairs if p not in self.distances_))
+    if missing:
+      d = self.diffs(missing)
+      for j, p in enumerate(missing):
+        self.distances_[p] = np.hypot(d[:, j, 0], d[:, j, 1])
+    return np.stack([self.distances_[p] for p in pairs], axis=1).reshape(len(self.idx_), len(pairs))
+
+  def neighbors(self, offset: int) -> np.ndarray:
+    # Prediction of the same person offset predictions away, -1 if missing or out of the
+    # temporal window. The window is in real frames, tracks step at least one frame at a time.
+    if offset not in self.neighbors_:
+      neighbors = self.store_.neighbor(offset)[self.idx_]
+      delta = self.store_.real_frames(neighbors) - self.store_.real_frames(self.idx_)
+      outside = (delta < -self.temporal_window_[0]) | (delta > self.temporal_window_[1])
+      neighbors[outside] = -1
+      self.neighbors_[offset] = neighbors
+    return self.neighbors_[offset]
+
+  def min_displacement(self, kp_id: int) -> np.ndarray:
+    # Smallest displacement of the keypoint wrt the same person within the temporal window
+    if kp_id not in self.displacements_:
+      positions = self.store_.keypoints_[self.idx_, kp_id, :2].astype(np.float64)
+      offsets = [o for o in range(-self.temporal_window_[0], self.temporal_window_[1] + 1) if o != 0]
+      displacement = np.full((len(self.idx_), len(offsets)), np.inf)
+      for j, offset in enumerate(offsets):
+        neighbors = self.neighbors(offset)
+        valid = neighbors >= 0
+        d = self.store_.keypoints_[neighbors[valid], kp_id, :2] - positions[valid]
+        displacement[valid, j] = np.hypot(d[:, 0], d[:, 1])
+      self.displacements_[kp_id] = displacement.min(axis=1, initial=np.inf)
+    return self.displacements_[kp_id]
+
+def open_shard_store(path: str, version: int) -> PoseStore:
+  # The cache is memory-mapped once per worker process and kept for the next shards
+  store = shard_stores.get(path)
+  if store is None or store.cache()[1] != version:
+    store = PoseStore.open(path)
+    shard_stores[path] = store
+  if store.cache()[1] != version:
+    raise RuntimeError('Dataset cache changed during the check: ' + path)
+  return store
+
+def evaluate_shard(cache: 'tuple[str, int]', start: int, stop: int, assertions: 'list[Assertion]', temporal_window: 'tuple[int,int]', idx: np.ndarray) -> 'dict[str, np.ndarray]':
+  # Runs in a worker: idx are predictions of the whole dataset, all within relative frames [start, stop)
+  dataset = open_shard_store(*cache)
+  store = dataset.slice_frames(start, stop)
+  checker = AssertionChecker(store, temporal_window)
+  for asst in assertions:
+    checker.register_assertion(asst)
+  return checker.evaluate(idx - dataset.frame_offsets_[start])
+
+def get_process_pool(workers: int) -> ProcessPoolExecutor:
+  # The pool is kept alive between requests, starting worker processes costs more than a check
+  global process_pool, process_pool_workers
+  if process_pool is None or process_pool_workers != workers:
+    if process_pool is not None:
+      process_pool.shutdown(wait=False)
+    process_pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(POOL_START_METHOD))
+    process_pool_workers = workers
+  return process_pool
 
 class AssertionChecker:
-    def __init__(self, dataset) -> None:
+    def __init__(self, dataset: PoseStore, temporal_window: 'tuple[int,int]' = TEMPORAL_WINDOW) -> None:
       self.assertions_ = {}
-      self.errors_ = []
       self.dataset_ = dataset
+      self.errors_ = ErrorTable(dataset)
+      self.temporal_window_ = temporal_window
 
     def register_assertion(self, assertion: Assertion) -> None:
         if assertion.name() is None:
@@ -121,133 +263,156 @@ class AssertionChecker:
         self.assertions_[assertion.name()] = assertion
 
     def retrieve_errors(self) -> pd.DataFrame:
-        errors = []
-
-        if not self.errors_:
+        if self.errors_.length() == 0:
           return None
-        
-        for error in self.errors_:
-          errors.append(error.get_data_as_df())
 
-        return pd.concat(errors, ignore_index=True)
+        return self.errors_.to_df()
 
     def clear_errors(self) -> None:
-        self.errors_ = []
+        self.errors_.clear()
 
-    def check(self, input) -> None:
-      for name, asst in self.assertions_.items():
-        if asst.function().type() == 'spatial':
-          err = self.__check_spatial_assertion(asst, input)
-        elif asst.function().type() == 'temporal':
-          err = self.__check_temporal_assertion(asst, input)
-        else:
-          raise RuntimeError('Wrong function type for assertion: ' + name)
+    def check(self, input: 'list[Prediction]', workers=1) -> None:
+      idx = np.array([p.get_index() for p in input], dtype=np.int64)
+      masks = self.evaluate(idx, workers)
+
+      for name in self.assertions_:
+        pred_idx = np.flatnonzero(masks[name])
+        self.errors_.append(name, pred_idx, idx[pred_idx])
 
-        if err:
-          self.errors_.extend(err)
+    def evaluate(self, idx: np.ndarray, workers=1) -> 'dict[str, np.ndarray]':
+      # Error mask of every registered assertion over the predictions in idx
+      # Workers open the binary cache of the dataset themselves, a store without one is checked here
+      if workers > 1 and len(idx) >= SHARD_MIN_PREDICTIONS and self.dataset_.cache() is not None:
+        # Stages of the worker processes are not visible from here, only the whole evaluation
+        with stage('evaluate_sharded', len(idx)):
+          return self.__evaluate_sharded(idx, workers)
 
-    def __check_spatial_assertion(self, asst: Assertion, input: 'list[Prediction]') -> 'list[LabellingError]':
+      with stage('features', len(idx)):
+        features = SharedFeatures(self.dataset_, idx, self.temporal_window_)
+        features.plan(list(self.assertions_.values()))
+
+      masks = {}
+      for name, asst in self.assertions_.items():
+        with stage('assertion', len(idx), assertion=name):
+          if asst.function().type() == 'spatial':
+            masks[name] = self.__check_spatial_assertion(asst, idx, features)
+          elif asst.function().type() == 'temporal':
+            masks[name] = self.__check_temporal_assertion(asst, idx, features)
+          elif asst.function().type() == 'overlap':
+            masks[name] = self.__check_overlap_assertion(asst, idx)
+          else:
+            raise RuntimeError('Wrong function type for assertion: ' + name)
+      return masks
+
+    def iter_evaluate(self, idx: np.ndarray, workers=1, first_chunk=STREAM_FIRST_CHUNK, max_chunk=STREAM_MAX_CHUNK):
+      # Same masks as evaluate, produced over consecutive chunks of idx as (start, masks) so
+      # the first errors are available early. Chunks grow up to the size that gets sharded.
+      start = 0
+      size = first_chunk
+      while start < len(idx):
+        chunk = idx[start:start+size]
+        yield start, self.evaluate(chunk, workers)
+        start += len(chunk)
+        size = min(2*size, max_chunk)
+
+    def __evaluate_sharded(self, idx: np.ndarray, workers: int) -> 'dict[str, np.ndarray]':
+      # Every shard is a frame range extended by a halo as wide as the temporal window, so neighbor
+      # lookups at the shard boundaries see the same frames as a serial run. Only the range is sent,
+      # the worker slices it out of its own mapping of the cache.
+      before, after = self.temporal_window_
+      cache = self.dataset_.cache()
+      pool = get_process_pool(workers)
+      futures = []
+
+      for shard in np.array_split(idx, workers*SHARDS_PER_WORKER):
+        if len(shard) == 0:
+          continue
+        frames = self.dataset_.pred_frame_[shard]
+        start = max(0, int(frames.min()) - before)
+        stop = min(self.dataset_.num_frames(), int(frames.max()) + after + 1)
+        futures.append(pool.submit(evaluate_shard, cache, start, stop, list(self.assertions_.values()), self.temporal_window_, shard))
+
+      # Shards are contiguous pieces of idx, so concatenating them keeps the original order
+      results = [f.result() for f in futures]
+      return {name: np.concatenate([r[name] for r in results] + [np.zeros(0, dtype=bool)]) for name in self.assertions_}
+
+    def __check_spatial_assertion(self, asst: Assertion, idx: np.ndarray, features: SharedFeatures) -> np.ndarray:
       fn = asst.function()
       atts = fn.attributes()
       kps = fn.keypoints()
-      errors = []
 
       if not all(kp in PoseTrack_COCO_Keypoint_Ordering for kp in kps):
         raise RuntimeError('Incorrect keypoints: ' + '-'.join(kps))
 
-      for ii, p in enumerate(input):
-        keypoint_positions = []
-        k = p.get_keypoints()
-        for kp in kps:
-          keypoint_positions.append(k[kp].position())
-
-        bbox_height = p.get_bbox()[-1]
-
-        # Relative position between keypoints
-        if PositionCondition.exists(atts[0]) and len(kps) == len(atts) * 2 and len(kps) % 2 == 0:
-          last_true = -1
-
-          for j, c in enumerate(atts):
-            cd = PositionCondition.from_name(c)
-            x_diff = keypoint_positions[j*2][0] - keypoint_positions[j*2+1][0]
-            y_diff = keypoint_positions[j*2][1] - keypoint_positions[j*2+1][1]
-            margin = 0.001*bbox_height
-
-            if cd is PositionCondition.ABOVE:
-              if y_diff < -margin:
-                if (j - last_true) == 1: last_true = j
-              elif abs(y_diff) < margin: last_true = len(atts)
-              
-            elif cd is PositionCondition.BELOW:
-              if y_diff > margin:
-                if (j - last_true) == 1: last_true = j
-              elif abs(y_diff) < margin: last_true = len(atts)
-
-            elif cd is PositionCondition.LEFT:
-              if x_diff < -margin:
-                if (j - last_true) == 1: last_true = j
-              elif abs(x_diff) < margin: last_true = len(atts)
-
-            elif cd is PositionCondition.RIGHT:
-              if x_diff > margin:
-                if (j - last_true) == 1: last_true = j
-              elif abs(x_diff) < margin: last_true = len(atts)
-            else:
-              raise RuntimeError('Incorrect condition: ' + c + ' for assertion: ' + asst.name())
-
-          if last_true == len(atts) - 2:
-            errors.append(LabellingError(asst, p, ii))
-
-        # Relative distance between keypoints wrt the height of the bounding box
-        elif len(atts[0]) == 2 and SizeCondition.exists(atts[0][0]) and len(kps) == len(atts) * 2 and len(kps) % 2 == 0:
-          last_true = -1
-
-          for j, c in enumerate(atts):
-            cd = SizeCondition.from_name(c[0])
-            if cd is SizeCondition.BIGGER and type(c[1]) in [int, float]:
-              if abs(distance.cdist([keypoint_positions[2*j]], [keypoint_positions[2*j+1]], 'euclidean')[0][0]) > c[1]*bbox_height:
-                if (j - last_true) == 1: last_true = j
-            elif cd is SizeCondition.SMALLER and type(c[1]) in [int, float]:
-              if abs(distance.cdist([keypoint_positions[2*j]], [keypoint_positions[2*j+1]], 'euclidean')[0][0]) < c[1]*bbox_height:
-                if (j - last_true) == 1: last_true = j
-            else:
-              raise RuntimeError('Incorrect condition: ' + str(c) + ' for assertion: ' + asst.name())
-
-          if last_true == len(atts) - 2:
-            errors.append(LabellingError(asst, p, ii))
-          
-        else:
-          raise RuntimeError('Wrong params for assertion: ' + asst.name())
-
-      return errors
-
-    def __check_temporal_assertion(self, asst: Assertion, input: 'list[Prediction]') -> 'list[LabellingError]':
+      if len(atts) == 0 or len(kps) != len(atts) * 2:
+        raise RuntimeError('Wrong params for assertion: ' + asst.name())
+
+      # Keypoint j*2 minus keypoint j*2+1 for every condition j, shape (len(idx), len(atts), 2)
+      pairs = keypoint_pairs(fn)
+      bbox_height = self.dataset_.bboxes_[idx, 3].astype(np.float64)
+
+      hits = np.zeros((len(idx), len(atts)), dtype=bool)
+      ties = np.zeros((len(idx), len(atts)), dtype=bool)
+
+      # Relative position between keypoints
+      if PositionCondition.exists(atts[0]):
+        margin = 0.001*bbox_height
+        diff = features.diffs(pairs)
+
+        for j, c in enumerate(atts):
+          cd = PositionCondition.from_name(c)
+          x_diff = diff[:, j, 0]
+          y_diff = diff[:, j, 1]
+
+          if cd is PositionCondition.ABOVE:
+            hits[:, j], ties[:, j] = y_diff < -margin, np.abs(y_diff) < margin
+          elif cd is PositionCondition.BELOW:
+            hits[:, j], ties[:, j] = y_diff > margin, np.abs(y_diff) < margin
+          elif cd is PositionCondition.LEFT:
+            hits[:, j], ties[:, j] = x_diff < -margin, np.abs(x_diff) < margin
+          elif cd is PositionCondition.RIGHT:
+            hits[:, j], ties[:, j] = x_diff > margin, np.abs(x_diff) < margin
+          else:
+            raise RuntimeError('Incorrect condition: ' + str(c) + ' for assertion: ' + asst.name())
+
+      # Relative distance between keypoints wrt the height of the bounding box
+      elif len(atts[0]) == 2 and SizeCondition.exists(atts[0][0]):
+        dist = features.distances(pairs)
+
+        for j, c in enumerate(atts):
+          cd = SizeCondition.from_name(c[0])
+          if cd is SizeCondition.BIGGER and type(c[1]) in [int, float]:
+            hits[:, j] = dist[:, j] > c[1]*bbox_height
+          elif cd is SizeCondition.SMALLER and type(c[1]) in [int, float]:
+            hits[:, j] = dist[:, j] < c[1]*bbox_height
+          else:
+            raise RuntimeError('Incorrect condition: ' + str(c) + ' for assertion: ' + asst.name())
+
+      else:
+        raise RuntimeError('Wrong params for assertion: ' + asst.name())
+
+      return chain_conditions(hits, ties)
+
+    def __check_temporal_assertion(self, asst: Assertion, idx: np.ndarray, features: SharedFeatures) -> np.ndarray:
       fn = asst.function()
       atts = fn.attributes()
       kps = fn.keypoints()
-      errors = []
 
       if not all(kp in PoseTrack_COCO_Keypoint_Ordering for kp in kps):
         raise RuntimeError('Incorrect keypoints: ' + '-'.join(kps))
 
-      if len(kps) == 1 and len(atts) == 1 and type(atts[0]) in [float,int]:
+      if not (len(kps) == 1 and len(atts) == 1 and type(atts[0]) in [float,int]):
+        raise RuntimeError('Incorrect parameters for assertion: ' + asst.name())
 
-        for ii, p1 in enumerate(input):
-          dist = []
-          x1,y1 = p1.get_keypoints()[kps[0]].position()
-          # 4 frame observation
-          for jj in range(-2, 2):
-            if jj == 0:
-              continue
-            p2 = get_prediction(self.dataset_, max(0, p1.get_relative_frame_number()+jj), p1.get_person())
-            if p2:
-              x2,y2 = p2.get_keypoints()[kps[0]].position()
-              dist.append(abs(distance.cdist([[x1,y1]], [[x2,y2]], 'euclidean')[0][0]))
+      min_displacement = features.min_displacement(PoseTrack_COCO_Keypoint_Ordering.index(kps[0]))
+      return np.isfinite(min_displacement) & (min_displacement > atts[0]*self.dataset_.bboxes_[idx, 3])
 
-          if len(dist) > 0 and np.min(dist) > atts[0]*p1.get_bbox()[3]:
-            errors.append(LabellingError(asst, p1, ii))
+    def __check_overlap_assertion(self, asst: Assertion, idx: np.ndarray) -> np.ndarray:
+      # Duplicated detections: another box of the same frame overlaps this one by more than the threshold
+      fn = asst.function()
+      atts = fn.attributes()
 
-      else:
+      if not (len(fn.keypoints()) == 0 and len(atts) == 1 and type(atts[0]) in [float,int]):
         raise RuntimeError('Incorrect parameters for assertion: ' + asst.name())
 
-      return errors
\ No newline at end of file
+      return self.dataset_.max_overlap()[idx] > atts[0]
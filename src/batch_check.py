@@ -0,0 +1,126 @@
+import os
+import sys
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from assertions import ErrorTable
+from dataset_io import load_dataset
+from dataset_registry import DatasetRegistry
+from dsl import compile_assertions, DslError
+from error_store import ErrorStore
+from ui_utils import get_dataset_subset, check_assertions
+
+OUTPUT_FORMATS = ['csv', 'parquet']
+
+def dataset_name(json_path: str) -> str:
+  # ./static/dataset/X/X.pose.json -> X
+  return os.path.basename(json_path)[:-len('.pose.json')]
+
+def check_dataset(json_path: str, assertions: 'list[dict]', tags: 'list[str]', output: str, fmt: str, keep_errors=False) -> dict:
+  # Runs in a worker process: checks one dataset and writes its error table. The table is
+  # only sent back with keep_errors, for the error store, otherwise just its size.
+  name = dataset_name(json_path)
+  start = time.time()
+  try:
+    dataset = load_dataset(json_path)
+    base_path = json_path[:-len('.pose.json')]
+    res = get_dataset_subset(dataset, base_path, tags, 0, 0, False) or []
+    errors, _ = check_assertions(base_path, dataset, res, assertions)
+    if errors is None:
+      errors = ErrorTable(dataset).to_df()
+
+    path = os.path.join(output, name + '.errors.' + fmt)
+    if fmt == 'parquet':
+      errors.to_parquet(path, index=False)
+    else:
+      errors.to_csv(path, index=False)
+  except Exception as e:
+    return {'dataset': name, 'ok': False, 'message': str(e), 'seconds': time.time() - start}
+
+  return {'dataset': name, 'ok': True, 'path': path, 'predictions': sum(b.length() for b in res),
+          'num_errors': len(errors), 'errors': errors if keep_errors else None, 'seconds': time.time() - start}
+
+def find_datasets(paths: 'list[str]') -> 'list[str]':
+  # Arguments are .pose.json files, dataset folders or folders of datasets
+  found = []
+  for path in paths:
+    if path.endswith('.pose.json'):
+      found.append(path)
+      continue
+
+    own = os.path.join(path, os.path.basename(os.path.normpath(path)) + '.pose.json')
+    if os.path.isfile(own):
+      found.append(own)
+    else:
+      registry = DatasetRegistry(path)
+      found.extend(registry.path(name) + '.pose.json' for name in registry.discover())
+  return found
+
+def parse_args(argv: 'list[str]') -> argparse.Namespace:
+  parser = argparse.ArgumentParser(description='Check an assertion suite over many datasets without the web interface.')
+  parser.add_argument('datasets', nargs='+', help='.pose.json files, dataset folders or folders containing datasets')
+  parser.add_argument('-a', '--assertions', required=True, help='file with the assertion list, same DSL as the interface')
+  parser.add_argument('-o', '--output', default='./errors/', help='folder of the per-dataset error tables')
+  parser.add_argument('-f', '--format', choices=OUTPUT_FORMATS, default='csv')
+  parser.add_argument('-t', '--tags', nargs='*', default=[], help='search conditions applied before checking (right, left, slow, fast)')
+  parser.add_argument('--min-size', default='0', help='minimum bbox height, in %% of the frame height')
+  parser.add_argument('--max-size', default='100', help='maximum bbox height, in %% of the frame height')
+  parser.add_argument('-j', '--workers', type=int, default=os.cpu_count() or 1, help='datasets checked in parallel')
+  parser.add_argument('--error-store', help='SQLite error store where every dataset is recorded as a run')
+  args = parser.parse_args(argv)
+
+  if args.format == 'parquet':
+    try:
+      import pyarrow
+    except ImportError:
+      parser.error('parquet output needs pyarrow installed')
+  return args
+
+def main(argv: 'list[str]') -> int:
+  args = parse_args(argv)
+  with open(args.assertions, 'r') as f:
+    source = f.read()
+  try:
+    assertions = [fn.to_dict() for fn in compile_assertions(source)]
+  except DslError as e:
+    print(args.assertions + ': ' + str(e), file=sys.stderr)
+    return 2
+
+  json_paths = find_datasets(args.datasets)
+  if not json_paths:
+    print('No datasets found', file=sys.stderr)
+    return 2
+
+  os.makedirs(args.output, exist_ok=True)
+  tags = args.tags + [args.min_size, args.max_size]
+  store = ErrorStore(args.error_store) if args.error_store else None
+
+  start = time.time()
+  predictions = 0
+  num_errors = 0
+  failed = []
+  with ProcessPoolExecutor(max_workers=max(1, args.workers)) as pool:
+    futures = [pool.submit(check_dataset, p, assertions, tags, args.output, args.format, store is not None) for p in json_paths]
+    for i, future in enumerate(as_completed(futures)):
+      r = future.result()
+      if not r['ok']:
+        failed.append(r['dataset'])
+        print('[{}/{}] {}: failed: {}'.format(i+1, len(futures), r['dataset'], r['message']), file=sys.stderr)
+        continue
+
+      predictions += r['predictions']
+      num_errors += r['num_errors']
+      if store is not None:
+        # Runs are written from this process only, SQLite serializes writers anyway
+        store.add_errors(r['dataset'], assertions, tags, r['errors'])
+      print('[{}/{}] {}: {} predictions, {} errors, {:.2f}s -> {}'.format(
+        i+1, len(futures), r['dataset'], r['predictions'], r['num_errors'], r['seconds'], r['path']))
+
+  elapsed = time.time() - start
+  print('{} datasets ({} failed), {} predictions, {} errors in {:.2f}s: {:.0f} predictions/s'.format(
+    len(json_paths), len(failed), predictions, num_errors, elapsed, predictions / max(elapsed, 1e-9)))
+  return 1 if failed else 0
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,157 @@
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import numpy as np
+
+from dataset_io import ingest_json, load_dataset
+from dataset_registry import DatasetRegistry
+from synthetic import write_dataset, frames_for, GENERATOR_VERSION
+from ui_utils import Condition, get_dataset_subset, check_assertions
+
+REPORT_VERSION = 1
+BENCHMARK_SIZES = [10000, 100000, 1000000]
+BENCHMARK_PERSONS = 10
+BENCHMARK_SEED = 0
+
+SPATIAL_SUITE = [
+  {'keypoints': ['right_elbow', 'right_shoulder', 'right_wrist', 'right_shoulder'], 'type': 'spatial', 'attributes': ['above', 'above']},
+  {'keypoints': ['right_wrist', 'left_wrist'], 'type': 'spatial', 'attributes': ['left']},
+  {'keypoints': ['left_elbow', 'right_elbow', 'left_wrist', 'right_wrist'], 'type': 'spatial', 'attributes': [['smaller', 0.05], ['smaller', 0.15]]},
+]
+TEMPORAL_SUITE = [
+  {'keypoints': ['right_wrist'], 'type': 'temporal', 'attributes': [0.3]},
+  {'keypoints': ['nose'], 'type': 'temporal', 'attributes': [0.2]},
+]
+
+def dataset_path(workdir: str, size: int) -> str:
+  name = 'SYN{}'.format(size)
+  return os.path.join(workdir, name, name + '.pose.json')
+
+def prepare(workdir: str, size: int) -> str:
+  # Datasets are deterministic, an existing file with the same parameters and generator
+  # version is reused
+  json_path = dataset_path(workdir, size)
+  params = {'persons': BENCHMARK_PERSONS, 'seed': BENCHMARK_SEED}
+  info_path = json_path[:-len('.pose.json')] + '.injected.json'
+  try:
+    with open(info_path) as f:
+      info = json.load(f)
+    if info['params'] == params and info.get('generator') == GENERATOR_VERSION and os.path.isfile(json_path):
+      return json_path
+  except (OSError, ValueError, KeyError):
+    pass
+
+  write_dataset(json_path, frames_for(size, BENCHMARK_PERSONS, 0.02), **params)
+  return json_path
+
+def timed(fn, repeat: int) -> 'list[float]':
+  runs = []
+  for _ in range(repeat):
+    start = time.perf_counter()
+    fn()
+    runs.append(time.perf_counter() - start)
+  return runs
+
+def handler_benchmarks(workdir: str, name: str) -> dict:
+  # /search and /check through the Flask test client, with every result cache emptied
+  # before a run so the handlers do the full work
+  import app
+  from result_cache import ResultCache, MaskCache
+  app.registry = DatasetRegistry(workdir)
+  app.error_store = None
+  client = app.app.test_client()
+
+  def post(path, payload):
+    app.result_cache = ResultCache()
+    app.mask_cache = MaskCache()
+    r = client.post(path, json=payload)
+    if r.status_code != 200:
+      raise RuntimeError(path + ' failed with status ' + str(r.status_code))
+
+  search = {'dataset': name, 'checkbox': ['right', '10', '90'], 'batches': 0, 'frames': 0}
+  check = {'dataset': name, 'assertions': json.dumps(SPATIAL_SUITE + TEMPORAL_SUITE), 'checkbox': ['10', '90']}
+  app.registry.get(name)
+  return {'handler_search': lambda: post('/search', search), 'handler_check': lambda: post('/check', check)}
+
+def run_size(workdir: str, size: int, repeat: int, workers: int, handlers: bool) -> 'list[dict]':
+  json_path = prepare(workdir, size)
+  base_path = json_path[:-len('.pose.json')]
+  name = os.path.basename(base_path)
+
+  dataset = load_dataset(json_path)
+  load_dataset(json_path) # makes sure the binary cache is valid before timing it
+  predictions = dataset.num_predictions()
+  everything = get_dataset_subset(dataset, base_path, ['0', '100'], 0, 0)
+
+  stages = {
+    'ingest_json': lambda: ingest_json(json_path),
+    'load_cache': lambda: load_dataset(json_path),
+    'subset_size': lambda: get_dataset_subset(dataset, base_path, ['10', '90'], 0, 0),
+  }
+  for c in Condition:
+    if c.ctype == 'temporal':
+      stages['subset_' + c.name] = lambda c=c: get_dataset_subset(dataset, base_path, [c.name, '10', '90'], 0, 0)
+  stages['check_spatial'] = lambda: check_assertions(base_path, dataset, everything, SPATIAL_SUITE, False, workers)
+  stages['check_temporal'] = lambda: check_assertions(base_path, dataset, everything, TEMPORAL_SUITE, False, workers)
+  stages['check_all'] = lambda: check_assertions(base_path, dataset, everything, SPATIAL_SUITE + TEMPORAL_SUITE, False, workers)
+  if handlers:
+    stages.update(handler_benchmarks(workdir, name))
+
+  results = []
+  for stage, fn in stages.items():
+    runs = timed(fn, repeat)
+    best = min(runs)
+    results.append({'size': size, 'predictions': predictions, 'stage': stage, 'seconds': runs,
+                    'min': best, 'median': float(np.median(runs)), 'predictions_per_second': predictions / max(best, 1e-9)})
+    print('{:>8} {:<16} {:9.4f}s {:>14.0f} pred/s'.format(size, stage, best, predictions / max(best, 1e-9)), file=sys.stderr)
+  return results
+
+def compare(report: dict, baseline: dict, tolerance: float) -> 'list[str]':
+  # Stages whose best time grew by more than the tolerance wrt the baseline report
+  previous = {(r['size'], r['stage']): r['min'] for r in baseline.get('results', [])}
+  slower = []
+  for r in report['results']:
+    before = previous.get((r['size'], r['stage']))
+    if before is not None and r['min'] > before * (1 + tolerance):
+      slower.append('{} {}: {:.4f}s -> {:.4f}s'.format(r['size'], r['stage'], before, r['min']))
+  return slower
+
+def main(argv: 'list[str]') -> int:
+  parser = argparse.ArgumentParser(description='Time the load, search and check pipeline on synthetic datasets.')
+  parser.add_argument('--sizes', type=int, nargs='+', default=BENCHMARK_SIZES, help='dataset sizes, in predictions')
+  parser.add_argument('--workdir', default=os.path.join(tempfile.gettempdir(), 'pose_benchmark'), help='where synthetic datasets are kept')
+  parser.add_argument('--repeat', type=int, default=3)
+  parser.add_argument('--workers', type=int, default=1, help='processes used by check_assertions')
+  parser.add_argument('--no-handlers', action='store_true', help='skip the /search and /check handlers')
+  parser.add_argument('-o', '--output', default='benchmark.json', help='json report')
+  parser.add_argument('--baseline', help='previous report, exits with 1 if a stage got slower')
+  parser.add_argument('--tolerance', type=float, default=0.2, help='slowdown allowed wrt the baseline')
+  args = parser.parse_args(argv)
+
+  report = {'version': REPORT_VERSION, 'created': time.time(), 'python': platform.python_version(),
+            'numpy': np.__version__, 'platform': platform.platform(), 'cpu_count': os.cpu_count(), 'generator': GENERATOR_VERSION,
+            'repeat': args.repeat, 'workers': args.workers, 'results': []}
+  for size in args.sizes:
+    report['results'].extend(run_size(args.workdir, size, args.repeat, args.workers, not args.no_handlers))
+
+  with open(args.output, 'w') as f:
+    json.dump(report, f, indent=2)
+
+  if args.baseline:
+    with open(args.baseline) as f:
+      baseline = json.load(f)
+    if baseline.get('generator') != GENERATOR_VERSION:
+      print('The baseline was measured on datasets of another synthetic generator, it is not compared', file=sys.stderr)
+      return 0
+    slower = compare(report, baseline, args.tolerance)
+    for line in slower:
+      print('slower: ' + line, file=sys.stderr)
+    return 1 if slower else 0
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,56 @@
+import numpy as np
+
+from tracking import box_iou
+
+BOX_INDEX_CHUNK = 1 << 16 # boxes whose candidate pairs are tested at once, bounds memory in dense frames
+
+def overlapping_pairs(frame_offsets: np.ndarray, bboxes: np.ndarray) -> 'tuple[np.ndarray, np.ndarray, np.ndarray]':
+  # Pairs (a, b) of predictions of the same frame whose xywh boxes intersect, with their IoU.
+  # The boxes of every frame are swept by their left edge: the only candidates of a box are the
+  # boxes that start between its own left and right edges, found by binary search, instead of
+  # every other box of the frame.
+  num_preds = len(bboxes)
+  empty = np.zeros(0, dtype=np.int64)
+  if num_preds == 0:
+    return empty, empty, np.zeros(0)
+
+  pred_frame = np.repeat(np.arange(len(frame_offsets) - 1), np.diff(frame_offsets))
+  left = bboxes[:, 0].astype(np.float64)
+  right = left + bboxes[:, 2]
+  order = np.lexsort((left, pred_frame))
+
+  # Sort key (frame, left edge) in a single float, a right edge never reaches the next frame
+  origin = left.min()
+  span = max(right.max(), left.max()) - origin + 1
+  keys = pred_frame[order] * span + (left[order] - origin)
+  ends = np.searchsorted(keys, pred_frame[order] * span + (right[order] - origin), 'left')
+
+  a_ = [empty]
+  b_ = [empty]
+  iou_ = [np.zeros(0)]
+  for start in range(0, num_preds, BOX_INDEX_CHUNK):
+    pos = np.arange(start, min(start + BOX_INDEX_CHUNK, num_preds))
+    counts = np.maximum(ends[pos] - pos - 1, 0)
+    first = np.repeat(pos + 1 - (np.cumsum(counts) - counts), counts)
+    a = order[np.repeat(pos, counts)]
+    b = order[first + np.arange(counts.sum())]
+    iou = box_iou(bboxes[a], bboxes[b])
+    keep = iou > 0
+    a_.append(a[keep])
+    b_.append(b[keep])
+    iou_.append(iou[keep])
+
+  return np.concatenate(a_), np.concatenate(b_), np.concatenate(iou_)
+
+def box_overlaps(frame_offsets: np.ndarray, bboxes: np.ndarray) -> 'tuple[np.ndarray, np.ndarray, np.ndarray]':
+  # Overlapping boxes per prediction in CSR layout: the predictions overlapping prediction i are
+  # ids[offsets[i]:offsets[i+1]], by decreasing IoU, and their IoUs are iou[offsets[i]:offsets[i+1]]
+  a, b, iou = overlapping_pairs(frame_offsets, bboxes)
+  src = np.concatenate([a, b])
+  ids = np.concatenate([b, a])
+  iou = np.concatenate([iou, iou])
+
+  order = np.lexsort((ids, -iou, src))
+  counts = np.bincount(src, minlength=len(bboxes))
+  offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+  return offsets, ids[order], iou[order]
@@ -1,7 +1,16 @@
+import os
 import numpy as np
 
+from tracking import link_tracks, tracks_from_links
+from box_index import box_overlaps
+
 W = 1920
 H = 1080
+FPS = 25 # frame rate of the videos
+
+# Arrays of a PoseStore as saved in its binary cache, one <name>.npy file each
+STORE_ARRAYS = ['frame_numbers', 'frame_offsets', 'keypoints', 'bboxes', 'scores', 'track_offsets', 'track_predictions']
+CACHE_MANIFEST = 'manifest.json' # written last in a cache folder, its mtime is the version of the cache
 
 # Endpoint1 , Endpoint2 , line_color
 PoseTrack_Keypoint_Pairs = [
@@ -58,8 +67,13 @@ class Prediction:
     self.person_ = None
     self.real_frame_number_ = -1
     self.relative_frame_number_ = -1
+    self.index_ = -1
+    self.store_ = None
 
   def get_keypoints(self) -> dict:
+    if len(self.keypoints_) == 0 and self.store_ is not None:
+      self.set_keypoints(self.store_.get_keypoints(self.index_))
+
     if len(list(self.keypoints_.keys())) == 0:
       raise RuntimeError('Empty keypoints list')
 
@@ -93,34 +107,248 @@ class Prediction:
   def set_relative_frame_number(self, frame_number: int) -> None:
     self.relative_frame_number_ = frame_number
 
-def get_bounding_box(file: dict, frame: int, person: int) -> tuple([int, int]):
-  if person >= len(file['person'][frame][1]): return None
-  return file['person'][frame][1][person]['xywh']
+  def get_index(self) -> int:
+    return self.index_
+
+  def set_store(self, store: 'PoseStore', index: int) -> None:
+    # Keypoints are read lazily from the store the first time they are requested
+    self.store_ = store
+    self.index_ = index
+
+class GrowableArray:
+  # Typed array with amortized O(1) appends along the first axis
+  def __init__(self, shape: tuple, dtype, capacity=1024) -> None:
+    self.data_ = np.empty((capacity,) + tuple(shape), dtype=dtype)
+    self.len_ = 0
+
+  def append(self, values) -> None:
+    values = np.asarray(values, dtype=self.data_.dtype).reshape((-1,) + self.data_.shape[1:])
+    end = self.len_ + len(values)
+    if end > len(self.data_):
+      data = np.empty((max(end, 2*len(self.data_)),) + self.data_.shape[1:], dtype=self.data_.dtype)
+      data[:self.len_] = self.data_[:self.len_]
+      self.data_ = data
+    self.data_[self.len_:end] = values
+    self.len_ = end
+
+  def length(self) -> int:
+    return self.len_
+
+  def array(self) -> np.ndarray:
+    return self.data_[:self.len_].copy()
+
+class PoseStore:
+  # Columnar view of a .pose.json dataset. Predictions are stored frame after
+  # frame, so the predictions of relative frame f are
+  # [frame_offsets[f], frame_offsets[f+1]) and person p of that frame is
+  # prediction frame_offsets[f] + p.
+  # Person p is not the same person from one frame to the next, so predictions are also linked
+  # into tracks, one per person and frame range: the predictions of track t, one per
+  # consecutive frame, are track_predictions[track_offsets[t]:track_offsets[t+1]].
+  def __init__(self, frame_numbers: np.ndarray, frame_offsets: np.ndarray, keypoints: np.ndarray,
+               bboxes: np.ndarray, scores: np.ndarray, track_offsets: np.ndarray = None,
+               track_predictions: np.ndarray = None) -> None:
+    self.frame_numbers_ = frame_numbers
+    self.frame_offsets_ = frame_offsets
+    self.keypoints_ = keypoints
+    self.bboxes_ = bboxes
+    self.scores_ = scores
+
+    counts = np.diff(frame_offsets)
+    self.pred_frame_ = np.repeat(np.arange(len(frame_numbers), dtype=np.int64), counts)
+    self.pred_person_ = np.arange(len(bboxes), dtype=np.int64) - frame_offsets[self.pred_frame_]
+
+    if track_offsets is None:
+      track_offsets, track_predictions = link_tracks(frame_numbers, frame_offsets, bboxes)
+    self.track_offsets_ = track_offsets
+    self.track_predictions_ = track_predictions
+    self.pred_track_ = np.empty(len(bboxes), dtype=np.int64)
+    self.pred_track_[track_predictions] = np.repeat(np.arange(len(track_offsets) - 1, dtype=np.int64), np.diff(track_offsets))
+    self.pred_position_ = np.empty(len(bboxes), dtype=np.int64)
+    self.pred_position_[track_predictions] = np.arange(len(bboxes), dtype=np.int64) - track_offsets[self.pred_track_[track_predictions]]
+    self.columns_ = {}
+    self.cache_ = None
+
+  @classmethod
+  def from_json(cls, file: dict) -> 'PoseStore':
+    frames = file['person']
+    num_preds = sum(len(f[1]) for f in frames)
+    num_kps = len(PoseTrack_COCO_Keypoint_Ordering)
+
+    frame_numbers = np.empty(len(frames), dtype=np.int64)
+    frame_offsets = np.zeros(len(frames) + 1, dtype=np.int64)
+    keypoints = np.empty((num_preds, num_kps, 3), dtype=np.float32)
+    bboxes = np.empty((num_preds, 4), dtype=np.float32)
+    scores = np.empty(num_preds, dtype=np.float32)
+
+    i = 0
+    for f, (frame_number, people) in enumerate(frames):
+      frame_numbers[f] = frame_number
+      for person in people:
+        keypoints[i] = person['pose'][0]
+        bboxes[i] = person['xywh']
+        scores[i] = person.get('score', 0)
+        i += 1
+      frame_offsets[f+1] = i
+
+    return cls(frame_numbers, frame_offsets, keypoints, bboxes, scores)
+
+  @classmethod
+  def open(cls, path: str, mmap=True) -> 'PoseStore':
+    # Store saved in the cache folder path. With mmap the arrays are paged in from disk on
+    # first access instead of being read upfront.
+    store = cls(*[np.load(path + name + '.npy', mmap_mode='r' if mmap else None) for name in STORE_ARRAYS])
+    store.set_cache(path)
+    return store
+
+  def set_cache(self, path: str) -> None:
+    self.cache_ = (path, os.stat(path + CACHE_MANIFEST).st_mtime_ns)
+
+  def cache(self) -> 'tuple[str, int]':
+    # (folder, version) of a binary cache holding the same arrays, None if there is none
+    return self.cache_
+
+  def num_frames(self) -> int:
+    return len(self.frame_numbers_)
+
+  def num_predictions(self) -> int:
+    return len(self.bboxes_)
+
+  def num_persons(self, frame: int) -> int:
+    return int(self.frame_offsets_[frame+1] - self.frame_offsets_[frame])
+
+  def nbytes(self) -> int:
+    arrays = [self.frame_numbers_, self.frame_offsets_, self.keypoints_, self.bboxes_, self.scores_,
+              self.pred_frame_, self.pred_person_, self.track_offsets_, self.track_predictions_,
+              self.pred_track_, self.pred_position_] + list(self.columns_.values())
+    return sum(a.nbytes for a in arrays)
+
+  def slice_frames(self, start: int, stop: int) -> 'PoseStore':
+    # Standalone copy of relative frames [start, stop); prediction i of the slice is
+    # prediction i + frame_offsets[start] of this store
+    lo, hi = self.frame_offsets_[start], self.frame_offsets_[stop]
+    prev = self.shift(np.arange(lo, hi), -1)
+    track_offsets, track_predictions = tracks_from_links(np.where(prev >= lo, prev - lo, -1))
+    return PoseStore(np.array(self.frame_numbers_[start:stop]), np.array(self.frame_offsets_[start:stop+1] - lo),
+                     np.array(self.keypoints_[lo:hi]), np.array(self.bboxes_[lo:hi]), np.array(self.scores_[lo:hi]),
+                     track_offsets, track_predictions)
+
+  def column(self, name: str, build) -> np.ndarray:
+    # Per-prediction derived column, built on first use and kept for the lifetime of the store
+    if name not in self.columns_:
+      self.columns_[name] = build()
+    return self.columns_[name]
+
+  def index(self, frame: int, person: int) -> int:
+    if frame < 0 or frame >= self.num_frames(): return -1
+    if person < 0 or person >= self.num_persons(frame): return -1
+    return int(self.frame_offsets_[frame] + person)
+
+  def indices(self, frames: np.ndarray, persons: np.ndarray) -> np.ndarray:
+    # Vectorized index(): prediction ids for every (frame, person) pair, -1 when missing
+    valid = (frames >= 0) & (frames < self.num_frames()) & (persons >= 0)
+    f = np.where(valid, frames, 0)
+    valid &= persons < self.frame_offsets_[f+1] - self.frame_offsets_[f]
+    return np.where(valid, self.frame_offsets_[f] + persons, -1)
+
+  def real_frames(self, idx: np.ndarray) -> np.ndarray:
+    return self.frame_numbers_[self.pred_frame_[idx]]
+
+  def frame_index(self) -> 'tuple[np.ndarray, np.ndarray]':
+    # Real frame numbers in ascending order and the relative frame of each of them
+    order = self.column('frame_order', lambda: np.argsort(self.frame_numbers_, kind='stable'))
+    return self.column('frame_sorted', lambda: np.asarray(self.frame_numbers_)[order]), order
+
+  def frame_range(self, first, last) -> 'tuple[np.ndarray, np.ndarray]':
+    # Binary search of [first, last] (ints or arrays of real frame numbers) in frame_index()
+    numbers, _ = self.frame_index()
+    return np.searchsorted(numbers, first, 'left'), np.searchsorted(numbers, last, 'right')
+
+  def predictions_between(self, first: int, last: int) -> np.ndarray:
+    # Predictions with a real frame number in [first, last], in prediction order
+    lo, hi = self.frame_range(first, last)
+    frames = np.sort(self.frame_index()[1][lo:hi])
+    starts = self.frame_offsets_[frames]
+    counts = self.frame_offsets_[frames+1] - starts
+    return np.repeat(starts - (np.cumsum(counts) - counts), counts) + np.arange(counts.sum(), dtype=np.int64)
+
+  def shift(self, idx: np.ndarray, offset) -> np.ndarray:
+    # Prediction of the same track offset predictions away (an int or one per idx), -1 when
+    # the track is not that long. Consecutive predictions of a track are consecutive relative
+    # frames, but can be a few real frames apart (see real_frames).
+    track = self.pred_track_[idx]
+    start = self.track_offsets_[track]
+    position = self.pred_position_[idx] + offset
+    valid = (position >= 0) & (position < self.track_offsets_[track+1] - start)
+    return np.where(valid, self.track_predictions_[np.where(valid, start + position, 0)], -1)
+
+  def neighbor(self, offset: int) -> np.ndarray:
+    # Prediction of the same track offset predictions away for every prediction, -1 when missing.
+    # Built once per store and shared by conditions, temporal assertions and result rows.
+    return self.column('neighbor_' + str(offset), lambda: self.shift(np.arange(self.num_predictions()), offset))
+
+  def prev_index(self) -> np.ndarray:
+    return self.neighbor(-1)
+
+  def next_index(self) -> np.ndarray:
+    return self.neighbor(1)
+
+  def box_index(self) -> 'tuple[np.ndarray, np.ndarray, np.ndarray]':
+    # Per prediction, the other predictions of its frame whose box intersects its own, in the
+    # CSR layout of box_overlaps. Built once per store.
+    if 'overlap_offsets' not in self.columns_:
+      offsets, ids, iou = box_overlaps(self.frame_offsets_, self.bboxes_)
+      self.columns_.update({'overlap_ids': ids, 'overlap_iou': iou, 'overlap_offsets': offsets})
+    return self.columns_['overlap_offsets'], self.columns_['overlap_ids'], self.columns_['overlap_iou']
+
+  def overlapping(self, idx: int, min_iou: float = 0) -> np.ndarray:
+    # Predictions of the same frame whose box overlaps the box of idx by more than min_iou
+    offsets, ids, iou = self.box_index()
+    lo, hi = offsets[idx], offsets[idx+1]
+    return ids[lo:hi][iou[lo:hi] > min_iou]
+
+  def max_overlap(self) -> np.ndarray:
+    # Largest IoU of every box with another box of its frame, 0 when it overlaps none
+    def build():
+      offsets, _, iou = self.box_index()
+      best = np.zeros(self.num_predictions())
+      has = offsets[1:] > offsets[:-1]
+      best[has] = iou[offsets[:-1][has]]
+      return best
+    return self.column('max_overlap', build)
+
+  def get_keypoints(self, idx: int) -> 'list[Keypoint]':
+    return [Keypoint(float(x), float(y), PoseTrack_COCO_Keypoint_Ordering[i])
+            for i, (x, y) in enumerate(self.keypoints_[idx, :, :2].tolist())]
 
-def get_keypoints(file: dict, frame: int, person: int) -> 'list[Keypoint]':
-  if person >= len(file['person'][frame][1]): return None
-  keypoints =  file['person'][frame][1][person]['pose'][0]
-  out = []
+  def get_bbox(self, idx: int) -> 'list[float]':
+    return self.bboxes_[idx].tolist()
 
-  for i, k in enumerate(keypoints):
-    out.append(Keypoint(k[0],k[1], PoseTrack_COCO_Keypoint_Ordering[i]))
+  def get_prediction(self, idx: int) -> Prediction:
+    frame = int(self.pred_frame_[idx])
 
-  return out
+    p = Prediction()
+    p.set_store(self, int(idx))
+    p.set_bbox(self.get_bbox(idx))
+    p.set_person(int(self.pred_person_[idx]))
+    p.set_relative_frame_number(frame)
+    p.set_real_frame_number(int(self.frame_numbers_[frame]))
+    return p
 
-def get_real_frame_number(file: dict, frame: int) -> int:
-  return file['person'][frame][0]
+def get_bounding_box(store: PoseStore, frame: int, person: int) -> 'list[float]':
+  idx = store.index(frame, person)
+  if idx < 0: return None
+  return store.get_bbox(idx)
 
-def get_prediction(file: dict, frame: int, person: int) -> Prediction:
-  keypoints = get_keypoints(file, frame, person)
-  bbox = get_bounding_box(file, frame, person)
+def get_keypoints(store: PoseStore, frame: int, person: int) -> 'list[Keypoint]':
+  idx = store.index(frame, person)
+  if idx < 0: return None
+  return store.get_keypoints(idx)
 
-  if not keypoints or not bbox:
-    return None
+def get_real_frame_number(store: PoseStore, frame: int) -> int:
+  return int(store.frame_numbers_[frame])
 
-  p = Prediction()
-  p.set_bbox(bbox)
-  p.set_keypoints(keypoints)
-  p.set_person(person)
-  p.set_relative_frame_number(frame)
-  p.set_real_frame_number(get_real_frame_number(file, frame))
-  return p
+def get_prediction(store: PoseStore, frame: int, person: int) -> Prediction:
+  idx = store.index(frame, person)
+  if idx < 0: return None
+  return store.get_prediction(idx)
@@ -0,0 +1,192 @@
+import os
+import re
+import sys
+import json
+import codecs
+import shutil
+import hashlib
+import numpy as np
+
+from data_utils import PoseStore, GrowableArray, PoseTrack_COCO_Keypoint_Ordering, STORE_ARRAYS, CACHE_MANIFEST
+
+CACHE_VERSION = 3
+SIGNATURE_SAMPLE_BYTES = 1 << 20 # bytes hashed at the head and the tail of the source file
+READ_CHUNK_BYTES = 1 << 20
+PROGRESS_FRAMES = 1000
+
+class FrameReader:
+  # Incremental reader of the 'person' array of a .pose.json file. Only the current
+  # chunk and the frame being decoded are held in memory.
+  def __init__(self, json_path: str, chunk_size=READ_CHUNK_BYTES) -> None:
+    self.file_ = open(json_path, 'rb')
+    self.decoder_ = codecs.getincrementaldecoder('utf-8')()
+    self.json_ = json.JSONDecoder()
+    self.chunk_size_ = chunk_size
+    self.buffer_ = ''
+    self.pos_ = 0
+    self.eof_ = False
+    self.bytes_read_ = 0
+    self.total_bytes_ = os.fstat(self.file_.fileno()).st_size
+
+  def close(self) -> None:
+    self.file_.close()
+
+  def bytes_read(self) -> int:
+    return self.bytes_read_
+
+  def total_bytes(self) -> int:
+    return self.total_bytes_
+
+  def __fill(self) -> None:
+    data = self.file_.read(self.chunk_size_)
+    self.bytes_read_ += len(data)
+    self.eof_ = len(data) == 0
+    self.buffer_ = self.buffer_[self.pos_:] + self.decoder_.decode(data, final=self.eof_)
+    self.pos_ = 0
+
+  def __skip(self, chars: str) -> None:
+    while True:
+      while self.pos_ < len(self.buffer_) and self.buffer_[self.pos_] in chars:
+        self.pos_ += 1
+      if self.pos_ < len(self.buffer_) or self.eof_:
+        return
+      self.__fill()
+
+  def __seek_person_array(self) -> None:
+    pattern = re.compile(r'"person"\s*:\s*\[')
+    while True:
+      m = pattern.search(self.buffer_, self.pos_)
+      if m:
+        self.pos_ = m.end()
+        return
+      if self.eof_:
+        raise RuntimeError('No person array found in dataset')
+      # Keep a tail in case the key is split between two chunks
+      self.pos_ = max(self.pos_, len(self.buffer_) - 64)
+      self.__fill()
+
+  def __iter__(self):
+    self.__seek_person_array()
+
+    while True:
+      self.__skip(' \t\r\n,')
+      if self.pos_ >= len(self.buffer_):
+        raise RuntimeError('Unexpected end of dataset')
+      if self.buffer_[self.pos_] == ']':
+        return
+
+      try:
+        frame, end = self.json_.raw_decode(self.buffer_, self.pos_)
+      except json.JSONDecodeError:
+        if self.eof_:
+          raise
+        # The frame continues in the next chunk
+        self.__fill()
+        continue
+
+      self.pos_ = end
+      yield frame
+
+def ingest_json(json_path: str, progress=None) -> PoseStore:
+  # Streaming equivalent of PoseStore.from_json(json.load(...)); peak memory is the
+  # output arrays plus a single frame. progress(bytes_read, total_bytes, num_frames)
+  # is called every PROGRESS_FRAMES frames.
+  num_kps = len(PoseTrack_COCO_Keypoint_Ordering)
+  frame_numbers = GrowableArray((), np.int64)
+  frame_offsets = GrowableArray((), np.int64)
+  keypoints = GrowableArray((num_kps, 3), np.float32)
+  bboxes = GrowableArray((4,), np.float32)
+  scores = GrowableArray((), np.float32)
+  frame_offsets.append(0)
+
+  reader = FrameReader(json_path)
+  try:
+    for frame_number, people in reader:
+      frame_numbers.append(frame_number)
+      if people:
+        keypoints.append([person['pose'][0] for person in people])
+        bboxes.append([person['xywh'] for person in people])
+        scores.append([person.get('score', 0) for person in people])
+      frame_offsets.append(keypoints.length())
+
+      if progress and frame_numbers.length() % PROGRESS_FRAMES == 0:
+        progress(reader.bytes_read(), reader.total_bytes(), frame_numbers.length())
+  finally:
+    reader.close()
+
+  if progress:
+    progress(reader.total_bytes(), reader.total_bytes(), frame_numbers.length())
+
+  return PoseStore(frame_numbers.array(), frame_offsets.array(), keypoints.array(), bboxes.array(), scores.array())
+
+def print_progress(bytes_read: int, total_bytes: int, num_frames: int) -> None:
+  sys.stderr.write('\r{:5.1f}% {} frames'.format(100*bytes_read/max(total_bytes, 1), num_frames))
+  if bytes_read >= total_bytes:
+    sys.stderr.write('\n')
+
+def cache_path(json_path: str) -> str:
+  # ./static/dataset/X/X.pose.json -> ./static/dataset/X/X.pose.cache/
+  return os.path.splitext(json_path)[0] + '.cache/'
+
+def source_signature(json_path: str) -> dict:
+  # Size and mtime catch regular rewrites; the sampled hash catches copies that preserve the mtime
+  st = os.stat(json_path)
+  h = hashlib.sha1()
+  with open(json_path, 'rb') as f:
+    h.update(f.read(SIGNATURE_SAMPLE_BYTES))
+    if st.st_size > 2*SIGNATURE_SAMPLE_BYTES:
+      f.seek(-SIGNATURE_SAMPLE_BYTES, os.SEEK_END)
+      h.update(f.read(SIGNATURE_SAMPLE_BYTES))
+
+  return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'sample_sha1': h.hexdigest()}
+
+def read_manifest(path: str) -> dict:
+  try:
+    with open(path + CACHE_MANIFEST, 'r') as f:
+      return json.load(f)
+  except (OSError, ValueError):
+    return None
+
+def save_store(store: PoseStore, path: str, signature: dict) -> None:
+  # Arrays are written to a temporary folder that replaces the cache in one rename,
+  # so a crash in the middle never leaves a half-written cache behind
+  tmp = path.rstrip('/') + '.tmp/'
+  shutil.rmtree(tmp, ignore_errors=True)
+  os.makedirs(tmp)
+
+  for name in STORE_ARRAYS:
+    np.save(tmp + name + '.npy', np.ascontiguousarray(getattr(store, name + '_')))
+
+  manifest = {'version': CACHE_VERSION, 'source': signature,
+              'num_frames': store.num_frames(), 'num_predictions': store.num_predictions()}
+  with open(tmp + CACHE_MANIFEST, 'w') as f:
+    json.dump(manifest, f)
+
+  shutil.rmtree(path, ignore_errors=True)
+  os.replace(tmp, path)
+
+def is_cache_valid(json_path: str) -> bool:
+  manifest = read_manifest(cache_path(json_path))
+  return manifest is not None and manifest.get('version') == CACHE_VERSION and \
+    manifest.get('source') == source_signature(json_path)
+
+def load_dataset(json_path: str, use_cache=True, progress=None) -> PoseStore:
+  if use_cache and is_cache_valid(json_path):
+    return PoseStore.open(cache_path(json_path))
+
+  signature = source_signature(json_path)
+  store = ingest_json(json_path, progress)
+
+  if use_cache:
+    try:
+      save_store(store, cache_path(json_path), signature)
+      store.set_cache(cache_path(json_path))
+    except OSError as e:
+      sys.stderr.write('Could not write dataset cache for ' + json_path + ': ' + str(e) + '\n')
+
+  return store
+
+if __name__ == '__main__':
+  # One-off conversion: python dataset_io.py ./static/dataset/X/X.pose.json [...]
+  for json_path in sys.argv[1:]:
+    load_dataset(json_path, progress=print_progress)
@@ -0,0 +1,101 @@
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from data_utils import PoseStore
+from dataset_io import load_dataset
+
+MAX_LOADED_BYTES = 4 << 30 # memory budget for the datasets kept loaded at the same time
+
+class DatasetRegistry:
+  # Datasets are folders ./static/dataset/<name>/ containing <name>.pose.json. They are
+  # loaded on first request and kept in an LRU bounded by the size of their arrays.
+  def __init__(self, root: str, max_bytes: int = MAX_LOADED_BYTES) -> None:
+    self.root_ = root if root.endswith('/') else root + '/'
+    self.max_bytes_ = max_bytes
+    self.stores_ = OrderedDict()
+    self.loading_ = {}
+    self.unload_listeners_ = []
+    self.lock_ = threading.Lock()
+    self.hits_ = 0
+    self.misses_ = 0
+    self.evictions_ = 0
+
+  def discover(self) -> 'list[str]':
+    if not os.path.isdir(self.root_):
+      return []
+    return sorted(name for name in os.listdir(self.root_) if self.exists(name))
+
+  def exists(self, name: str) -> bool:
+    # Names come from requests, so anything that is not a plain folder name is rejected
+    if not name or os.path.basename(name) != name or name.startswith('.'):
+      return False
+    return os.path.isfile(self.path(name) + '.pose.json')
+
+  def path(self, name: str) -> str:
+    # Base path of the dataset files: <path>.pose.json, <path>.mp4, ...
+    return self.root_ + name + '/' + name
+
+  def get(self, name: str) -> PoseStore:
+    # Loading can take minutes for a new .pose.json, so it runs outside of the lock: requests
+    # for loaded datasets are not blocked, and concurrent requests for the dataset being
+    # loaded wait for that same load instead of converting it again
+    with self.lock_:
+      if name in self.stores_:
+        self.hits_ += 1
+        self.stores_.move_to_end(name)
+        return self.stores_[name]
+
+      if not self.exists(name):
+        raise KeyError('Unknown dataset: ' + str(name))
+
+      loading = self.loading_.get(name)
+      if loading is None:
+        self.misses_ += 1
+        loading = self.loading_[name] = Future()
+        owner = True
+      else:
+        owner = False
+
+    if not owner:
+      return loading.result()
+
+    try:
+      store = load_dataset(self.path(name) + '.pose.json')
+    except BaseException as e:
+      with self.lock_:
+        del self.loading_[name]
+      loading.set_exception(e)
+      raise
+
+    with self.lock_:
+      del self.loading_[name]
+      self.stores_[name] = store
+      evicted = self.__evict()
+    loading.set_result(store)
+    for evicted_name in evicted:
+      for listener in self.unload_listeners_:
+        listener(evicted_name)
+    return store
+
+  def add_unload_listener(self, listener) -> None:
+    # listener(name) is called after a dataset is evicted, so caches built on it can be dropped
+    self.unload_listeners_.append(listener)
+
+  def __evict(self) -> 'list[str]':
+    # The most recently used dataset is always kept, even if it exceeds the budget on its own
+    evicted = []
+    while len(self.stores_) > 1 and self.loaded_bytes() > self.max_bytes_:
+      evicted.append(self.stores_.popitem(last=False)[0])
+      self.evictions_ += 1
+    return evicted
+
+  def loaded_bytes(self) -> int:
+    return sum(store.nbytes() for store in self.stores_.values())
+
+  def stats(self) -> dict:
+    with self.lock_:
+      return {'hits': self.hits_, 'misses': self.misses_, 'evictions': self.evictions_,
+              'loaded': list(self.stores_.keys()), 'loading': list(self.loading_.keys()), 'loaded_bytes': self.loaded_bytes(),
+              'max_bytes': self.max_bytes_}
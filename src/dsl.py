@@ -0,0 +1,218 @@
+import re
+
+from assertions import AssertionFunction, PositionCondition, SizeCondition
+from data_utils import PoseTrack_COCO_Keypoint_Ordering
+
+ASSERTION_KEYS = ['keypoints', 'type', 'attributes']
+ASSERTION_TYPES = ['spatial', 'temporal', 'overlap']
+
+TOKEN_RE = re.compile(r'''
+    (?P<space>\s+|\#[^\n]*)
+  | (?P<number>-?(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)
+  | (?P<string>'(?:[^'\\\n]|\\.)*'|"(?:[^"\\\n]|\\.)*")
+  | (?P<punct>[\[\]{}:,])
+''', re.VERBOSE)
+
+ESCAPES = {'n': '\n', 't': '\t', '\\': '\\', "'": "'", '"': '"'}
+
+class DslError(RuntimeError):
+  # Error at a character offset of the source, reported with its 1-based line and column
+  def __init__(self, message: str, source: str, position: int) -> None:
+    self.message_ = message
+    self.position_ = position
+    self.line_ = source.count('\n', 0, position) + 1
+    self.column_ = position - (source.rfind('\n', 0, position) + 1) + 1
+    super().__init__('{} (line {}, column {})'.format(message, self.line_, self.column_))
+
+  def message(self) -> str:
+    return self.message_
+
+  def position(self) -> int:
+    return self.position_
+
+  def line(self) -> int:
+    return self.line_
+
+  def column(self) -> int:
+    return self.column_
+
+  def to_dict(self) -> dict:
+    return {'message': self.message_, 'position': self.position_, 'line': self.line_, 'column': self.column_}
+
+class Node:
+  # Literal of the source (list, dict, string or number) with the offset where it starts.
+  # Lists hold Nodes, dicts hold (key Node, value Node) pairs.
+  def __init__(self, kind: str, value, position: int) -> None:
+    self.kind_ = kind
+    self.value_ = value
+    self.position_ = position
+
+  def kind(self) -> str:
+    return self.kind_
+
+  def value(self):
+    return self.value_
+
+  def position(self) -> int:
+    return self.position_
+
+  def plain(self):
+    if self.kind_ == 'list':
+      return [v.plain() for v in self.value_]
+    if self.kind_ == 'dict':
+      return {k.value(): v.plain() for k, v in self.value_}
+    return self.value_
+
+def tokenize(source: str) -> 'list[tuple]':
+  tokens = []
+  pos = 0
+  while pos < len(source):
+    m = TOKEN_RE.match(source, pos)
+    if m is None:
+      if source[pos] in '\'"':
+        raise DslError('Unterminated string', source, pos)
+      raise DslError('Unexpected character ' + repr(source[pos]), source, pos)
+
+    kind = m.lastgroup
+    text = m.group()
+    if kind == 'number':
+      tokens.append(('number', float(text) if any(c in text for c in '.eE') else int(text), pos))
+    elif kind == 'string':
+      tokens.append(('string', re.sub(r'\\(.)', lambda e: ESCAPES.get(e.group(1), e.group(1)), text[1:-1]), pos))
+    elif kind == 'punct':
+      tokens.append((text, text, pos))
+    pos = m.end()
+
+  tokens.append(('end', None, len(source)))
+  return tokens
+
+class Parser:
+  # Recursive descent over the tokens of a python-like literal. Trailing commas are allowed.
+  def __init__(self, source: str) -> None:
+    self.source_ = source
+    self.tokens_ = tokenize(source)
+    self.pos_ = 0
+
+  def parse(self) -> Node:
+    node = self.__value()
+    kind, _, pos = self.tokens_[self.pos_]
+    if kind != 'end':
+      raise DslError('Unexpected content after the assertion list', self.source_, pos)
+    return node
+
+  def __next(self) -> tuple:
+    token = self.tokens_[self.pos_]
+    self.pos_ += 1
+    return token
+
+  def __peek(self) -> str:
+    return self.tokens_[self.pos_][0]
+
+  def __expect(self, kind: str, what: str) -> tuple:
+    token = self.__next()
+    if token[0] != kind:
+      raise self.__unexpected(token, what)
+    return token
+
+  def __unexpected(self, token: tuple, what: str) -> DslError:
+    kind, value, pos = token
+    found = 'end of input' if kind == 'end' else repr(value) if kind == 'string' else str(value)
+    return DslError('Expected ' + what + ', found ' + found, self.source_, pos)
+
+  def __value(self) -> Node:
+    token = self.__next()
+    kind, value, pos = token
+    if kind == '[':
+      return Node('list', self.__items(']', self.__value), pos)
+    if kind == '{':
+      return Node('dict', self.__items('}', self.__pair), pos)
+    if kind in ('string', 'number'):
+      return Node(kind, value, pos)
+    raise self.__unexpected(token, 'a value')
+
+  def __pair(self) -> tuple:
+    kind, value, pos = self.__expect('string', 'a quoted key')
+    self.__expect(':', "':'")
+    return Node('string', value, pos), self.__value()
+
+  def __items(self, close: str, item) -> list:
+    items = []
+    while self.__peek() != close:
+      items.append(item())
+      if self.__peek() == ',':
+        self.__next()
+      elif self.__peek() != close:
+        raise self.__unexpected(self.tokens_[self.pos_], "',' or '" + close + "'")
+    self.__next()
+    return items
+
+def is_number(node: Node) -> bool:
+  return node.kind() == 'number'
+
+def validate_assertion(node: Node, source: str) -> AssertionFunction:
+  if node.kind() != 'dict':
+    raise DslError('Expected an assertion {...}', source, node.position())
+
+  fields = {}
+  for key, value in node.value():
+    if key.value() not in ASSERTION_KEYS:
+      raise DslError('Unknown key ' + repr(key.value()) + ', expected one of ' + ', '.join(ASSERTION_KEYS), source, key.position())
+    if key.value() in fields:
+      raise DslError('Duplicated key ' + repr(key.value()), source, key.position())
+    fields[key.value()] = value
+
+  for key in ASSERTION_KEYS:
+    if key not in fields:
+      raise DslError('Missing key ' + repr(key), source, node.position())
+
+  atype, kps, atts = fields['type'], fields['keypoints'], fields['attributes']
+  if atype.kind() != 'string' or atype.value() not in ASSERTION_TYPES:
+    raise DslError('Type must be one of ' + ', '.join(ASSERTION_TYPES), source, atype.position())
+
+  if atype.value() == 'overlap':
+    if kps.kind() != 'list' or len(kps.value()) != 0:
+      raise DslError('Overlap assertions compare bounding boxes, keypoints must be []', source, kps.position())
+  elif kps.kind() != 'list' or len(kps.value()) == 0:
+    raise DslError('Keypoints must be a non-empty list', source, kps.position())
+  for kp in kps.value():
+    if kp.kind() != 'string' or kp.value() not in PoseTrack_COCO_Keypoint_Ordering:
+      raise DslError('Unknown keypoint ' + repr(kp.value()), source, kp.position())
+
+  if atts.kind() != 'list' or len(atts.value()) == 0:
+    raise DslError('Attributes must be a non-empty list', source, atts.position())
+
+  if atype.value() == 'overlap':
+    if len(atts.value()) != 1 or not is_number(atts.value()[0]) or not 0 <= atts.value()[0].value() < 1:
+      raise DslError('Overlap assertions take a single IoU threshold in [0, 1)', source, atts.position())
+
+  elif atype.value() == 'temporal':
+    if len(kps.value()) != 1:
+      raise DslError('Temporal assertions take a single keypoint', source, kps.position())
+    if len(atts.value()) != 1 or not is_number(atts.value()[0]):
+      raise DslError('Temporal assertions take a single numeric threshold', source, atts.position())
+
+  else:
+    if len(kps.value()) != 2*len(atts.value()):
+      raise DslError('Spatial assertions take two keypoints per attribute ({} keypoints, {} attributes)'.format(
+        len(kps.value()), len(atts.value())), source, kps.position())
+
+    # Attributes are either all relative positions or all [size, threshold] pairs
+    sizes = atts.value()[0].kind() == 'list'
+    for att in atts.value():
+      if sizes:
+        v = att.value() if att.kind() == 'list' else []
+        if len(v) != 2 or v[0].kind() != 'string' or not SizeCondition.exists(v[0].value()) or not is_number(v[1]):
+          raise DslError('Expected a size condition [bigger|smaller, threshold]', source, att.position())
+      elif att.kind() != 'string' or not PositionCondition.exists(att.value()):
+        raise DslError('Expected a position condition (above, below, left, right)', source, att.position())
+
+  return AssertionFunction(kps.plain(), atype.value(), atts.plain())
+
+def compile_assertions(source: str) -> 'list[AssertionFunction]':
+  # DSL text of the editor -> validated assertion functions, or DslError with the position
+  root = Parser(source).parse()
+  if root.kind() != 'list':
+    raise DslError('Expected a list of assertions [...]', source, root.position())
+  if len(root.value()) == 0:
+    raise DslError('No assertions given', source, root.position())
+  return [validate_assertion(node, source) for node in root.value()]
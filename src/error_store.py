@@ -0,0 +1,133 @@
+import json
+import time
+import sqlite3
+import threading
+import numpy as np
+import pandas as pd
+
+ERROR_QUERY_LIMIT = 1000 # rows returned by a query when no limit is given
+ERROR_GROUPS = ['assertion', 'person', 'frame']
+ERROR_STORE_MAX_RUNS = 50 # runs kept per dataset, older ones are deleted with their errors
+SCHEMA_VERSION = 2 # 1 stored the position of the prediction in its frame as person
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  dataset TEXT NOT NULL,
+  created REAL NOT NULL,
+  assertions TEXT NOT NULL,
+  tags TEXT NOT NULL,
+  num_errors INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS errors (
+  run INTEGER NOT NULL REFERENCES runs(id) ON DELETE CASCADE,
+  dataset TEXT NOT NULL,
+  assertion TEXT NOT NULL,
+  frame INTEGER NOT NULL,
+  relative_frame INTEGER NOT NULL,
+  person INTEGER NOT NULL,
+  position INTEGER NOT NULL
+);
+DROP INDEX IF EXISTS errors_lookup;
+CREATE INDEX IF NOT EXISTS errors_frame ON errors (run, frame, position);
+CREATE INDEX IF NOT EXISTS errors_run ON errors (run, assertion, frame, person);
+CREATE INDEX IF NOT EXISTS runs_dataset ON runs (dataset, id);
+'''
+
+class ErrorStore:
+  # Local SQLite database with the errors of every check, so past runs can be filtered
+  # and aggregated without checking again. Frames are real frame numbers, persons are track
+  # ids of the store and positions the index of the prediction in its frame. Only the last
+  # max_runs runs of every dataset are kept.
+  def __init__(self, path: str, max_runs: int = ERROR_STORE_MAX_RUNS) -> None:
+    self.path_ = path
+    self.max_runs_ = max_runs
+    self.lock_ = threading.Lock()
+    self.db_ = sqlite3.connect(path, check_same_thread=False)
+    self.db_.execute('PRAGMA journal_mode=WAL')
+    self.db_.execute('PRAGMA foreign_keys=ON')
+    if self.db_.execute('PRAGMA user_version').fetchone()[0] != SCHEMA_VERSION:
+      # Persons of older stores are not the same people across frames, their runs are dropped
+      self.db_.executescript('DROP TABLE IF EXISTS errors; DROP TABLE IF EXISTS runs;')
+    self.db_.executescript(SCHEMA)
+    self.db_.execute('PRAGMA user_version = ' + str(SCHEMA_VERSION))
+
+  def close(self) -> None:
+    with self.lock_:
+      self.db_.close()
+
+  def add_run(self, dataset: str, assertions: 'list[dict]', tags: 'list[str]', names: 'list[str]',
+              frames: np.ndarray, relative_frames: np.ndarray, persons: np.ndarray, positions: np.ndarray) -> int:
+    # One transaction per run, errors are inserted with a single executemany
+    rows = zip([dataset]*len(names), names, np.asarray(frames).tolist(), np.asarray(relative_frames).tolist(),
+               np.asarray(persons).tolist(), np.asarray(positions).tolist())
+    with self.lock_, self.db_:
+      cur = self.db_.execute('INSERT INTO runs (dataset, created, assertions, tags, num_errors) VALUES (?, ?, ?, ?, ?)',
+                             (dataset, time.time(), json.dumps(assertions), json.dumps(tags), len(names)))
+      run = cur.lastrowid
+      self.db_.executemany('INSERT INTO errors (run, dataset, assertion, frame, relative_frame, person, position) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                           ((run,) + r for r in rows))
+      # Errors of the deleted runs go with them (ON DELETE CASCADE)
+      self.db_.execute('DELETE FROM runs WHERE dataset = ? AND id NOT IN (SELECT id FROM runs WHERE dataset = ? ORDER BY id DESC LIMIT ?)',
+                       (dataset, dataset, self.max_runs_))
+    return run
+
+  def add_errors(self, dataset: str, assertions: 'list[dict]', tags: 'list[str]', errors: pd.DataFrame) -> int:
+    # errors as returned by AssertionChecker.retrieve_errors (None when nothing was found)
+    if errors is None:
+      errors = pd.DataFrame({'assertion': [], 'frame_number': [], 'relative_frame_number': [], 'person': [], 'track': []})
+    return self.add_run(dataset, assertions, tags, errors['assertion'].tolist(), errors['frame_number'].to_numpy(),
+                        errors['relative_frame_number'].to_numpy(), errors['track'].to_numpy(), errors['person'].to_numpy())
+
+  def runs(self, dataset: str = None, limit: int = ERROR_QUERY_LIMIT) -> 'list[dict]':
+    sql = 'SELECT id, dataset, created, assertions, tags, num_errors FROM runs'
+    args = []
+    if dataset is not None:
+      sql += ' WHERE dataset = ?'
+      args.append(dataset)
+    sql += ' ORDER BY id DESC LIMIT ?'
+    args.append(limit)
+
+    with self.lock_:
+      rows = self.db_.execute(sql, args).fetchall()
+    return [{'run': r[0], 'dataset': r[1], 'created': r[2], 'assertions': json.loads(r[3]),
+             'tags': json.loads(r[4]), 'num_errors': r[5]} for r in rows]
+
+  def latest_run(self, dataset: str) -> int:
+    with self.lock_:
+      row = self.db_.execute('SELECT MAX(id) FROM runs WHERE dataset = ?', (dataset,)).fetchone()
+    return row[0]
+
+  def __where(self, dataset: str, run: int, assertion: str = None, person: int = None,
+              frame_min: int = None, frame_max: int = None) -> tuple:
+    clauses = ['run = ?', 'dataset = ?']
+    args = [run, dataset]
+    for clause, value in (('assertion = ?', assertion), ('person = ?', person),
+                          ('frame >= ?', frame_min), ('frame <= ?', frame_max)):
+      if value is not None:
+        clauses.append(clause)
+        args.append(value)
+    return ' WHERE ' + ' AND '.join(clauses), args
+
+  def query(self, dataset: str, run: int, assertion: str = None, person: int = None, frame_min: int = None,
+            frame_max: int = None, limit: int = ERROR_QUERY_LIMIT, offset: int = 0) -> tuple(['list[dict]', int]):
+    # Errors of a run ordered by frame, and how many match the filter in total
+    where, args = self.__where(dataset, run, assertion, person, frame_min, frame_max)
+    with self.lock_:
+      total = self.db_.execute('SELECT COUNT(*) FROM errors' + where, args).fetchone()[0]
+      rows = self.db_.execute('SELECT assertion, frame, relative_frame, person, position FROM errors' + where +
+                              ' ORDER BY frame, position, assertion LIMIT ? OFFSET ?', args + [limit, offset]).fetchall()
+    return [{'assertion': r[0], 'frame': r[1], 'relative_frame': r[2], 'person': r[3], 'position': r[4]} for r in rows], total
+
+  def summary(self, dataset: str, run: int, group: 'list[str]', assertion: str = None, person: int = None,
+              frame_min: int = None, frame_max: int = None, limit: int = ERROR_QUERY_LIMIT) -> 'list[dict]':
+    # Error counts grouped by any of ERROR_GROUPS, largest groups first
+    if not group or any(g not in ERROR_GROUPS for g in group):
+      raise RuntimeError('Errors can be grouped by ' + ', '.join(ERROR_GROUPS))
+
+    where, args = self.__where(dataset, run, assertion, person, frame_min, frame_max)
+    columns = ', '.join(group)
+    with self.lock_:
+      rows = self.db_.execute('SELECT ' + columns + ', COUNT(*), MIN(frame), MAX(frame) FROM errors' + where +
+                              ' GROUP BY ' + columns + ' ORDER BY COUNT(*) DESC, ' + columns + ' LIMIT ?', args + [limit]).fetchall()
+    return [dict(zip(group + ['count', 'first_frame', 'last_frame'], r)) for r in rows]
@@ -0,0 +1,156 @@
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+
+# Upper bounds of the histogram buckets, in seconds
+TIME_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+METRICS_PREFIX = 'pose_'
+
+current_timer = contextvars.ContextVar('current_timer', default=None)
+
+class Histogram:
+  def __init__(self, buckets: 'list[float]' = TIME_BUCKETS) -> None:
+    self.buckets_ = buckets
+    self.counts_ = [0] * (len(buckets) + 1)
+    self.sum_ = 0.0
+    self.count_ = 0
+
+  def observe(self, value: float) -> None:
+    i = 0
+    while i < len(self.buckets_) and value > self.buckets_[i]:
+      i += 1
+    self.counts_[i] += 1
+    self.sum_ += value
+    self.count_ += 1
+
+  def cumulative(self) -> 'list[tuple]':
+    out = []
+    total = 0
+    for le, n in zip(self.buckets_ + [float('inf')], self.counts_):
+      total += n
+      out.append(('+Inf' if le == float('inf') else repr(le), total))
+    return out
+
+class MetricsCollector:
+  # Process-wide histograms and counters, rendered in the Prometheus text format
+  def __init__(self) -> None:
+    self.lock_ = threading.Lock()
+    self.histograms_ = {}
+    self.counters_ = {}
+    self.help_ = {}
+
+  def observe(self, metric: str, labels: dict, value: float, help: str = '') -> None:
+    key = (metric, tuple(sorted(labels.items())))
+    with self.lock_:
+      if key not in self.histograms_:
+        self.histograms_[key] = Histogram()
+        self.help_.setdefault(metric, help)
+      self.histograms_[key].observe(value)
+
+  def inc(self, metric: str, labels: dict, value: float = 1, help: str = '') -> None:
+    key = (metric, tuple(sorted(labels.items())))
+    with self.lock_:
+      self.counters_[key] = self.counters_.get(key, 0) + value
+      self.help_.setdefault(metric, help)
+
+  def render(self) -> str:
+    lines = []
+    with self.lock_:
+      for metric in sorted({m for m, _ in self.histograms_}):
+        lines += ['# HELP ' + METRICS_PREFIX + metric + ' ' + self.help_[metric], '# TYPE ' + METRICS_PREFIX + metric + ' histogram']
+        for (m, labels), h in sorted(self.histograms_.items()):
+          if m != metric:
+            continue
+          for le, n in h.cumulative():
+            lines.append(METRICS_PREFIX + metric + '_bucket' + format_labels(labels + (('le', le),)) + ' ' + str(n))
+          lines.append(METRICS_PREFIX + metric + '_sum' + format_labels(labels) + ' ' + repr(h.sum_))
+          lines.append(METRICS_PREFIX + metric + '_count' + format_labels(labels) + ' ' + str(h.count_))
+
+      for metric in sorted({m for m, _ in self.counters_}):
+        lines += ['# HELP ' + METRICS_PREFIX + metric + ' ' + self.help_[metric], '# TYPE ' + METRICS_PREFIX + metric + ' counter']
+        for (m, labels), v in sorted(self.counters_.items()):
+          if m == metric:
+            lines.append(METRICS_PREFIX + metric + format_labels(labels) + ' ' + str(v))
+    return '\n'.join(lines) + '\n'
+
+def format_labels(labels: tuple) -> str:
+  if not labels:
+    return ''
+  escaped = [(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in labels]
+  return '{' + ','.join(k + '="' + v + '"' for k, v in escaped) + '}'
+
+collector = MetricsCollector()
+
+class RequestTimer:
+  # Stage timings of one request. Repeated stages (one per batch or chunk) are added up,
+  # and reach the histograms once per request when the timer is finished.
+  def __init__(self, endpoint: str) -> None:
+    self.endpoint_ = endpoint
+    self.start_ = time.perf_counter()
+    self.stages_ = {}
+    self.finished_ = False
+
+  def record(self, name: str, seconds: float, items: int, labels: dict) -> None:
+    seconds_, items_, _ = self.stages_.get(name, (0.0, 0, labels))
+    self.stages_[name] = (seconds_ + seconds, items_ + items, labels)
+
+  def elapsed(self) -> float:
+    return time.perf_counter() - self.start_
+
+  def timings(self) -> dict:
+    return {name: {'ms': round(1000*s, 3), 'items': n} for name, (s, n, _) in self.stages_.items()}
+
+  def server_timing(self) -> str:
+    # Server-Timing header: <stage>;dur=<ms>;desc="<items> items"
+    parts = ['{};dur={:.3f};desc="{} items"'.format(name, 1000*s, n) for name, (s, n, _) in self.stages_.items()]
+    parts.append('total;dur={:.3f}'.format(1000*self.elapsed()))
+    return ', '.join(parts)
+
+  def finish(self) -> None:
+    if self.finished_:
+      return
+    self.finished_ = True
+    for name, (seconds, items, labels) in self.stages_.items():
+      observe_stage(labels, seconds, items)
+    collector.observe('request_seconds', {'endpoint': self.endpoint_}, self.elapsed(), 'Wall time of the requests')
+
+  @contextmanager
+  def activate(self):
+    token = current_timer.set(self)
+    try:
+      yield self
+    finally:
+      current_timer.reset(token)
+
+def observe_stage(labels: dict, seconds: float, items: int) -> None:
+  collector.observe('stage_seconds', labels, seconds, 'Wall time of the stages of a request')
+  collector.inc('stage_items_total', labels, items, 'Items processed by every stage')
+
+def record(stage: str, seconds: float, items: int = 0, **labels) -> None:
+  # Outside of a request (batch checks, benchmarks) stages go straight to the histograms
+  name = '.'.join([stage] + [str(labels[k]) for k in sorted(labels)])
+  labels = dict(labels, stage=stage)
+  timer = current_timer.get()
+  if timer is None:
+    observe_stage(labels, seconds, items)
+  else:
+    timer.record(name, seconds, items, labels)
+
+class Stage:
+  def __init__(self) -> None:
+    self.items_ = 0
+
+  def add(self, items: int) -> None:
+    self.items_ += items
+
+@contextmanager
+def stage(name: str, items: int = 0, **labels):
+  # with stage('predicate') as s: ...; s.add(n)
+  s = Stage()
+  s.add(items)
+  start = time.perf_counter()
+  try:
+    yield s
+  finally:
+    record(name, time.perf_counter() - start, s.items_, **labels)
@@ -0,0 +1,131 @@
+import json
+import hashlib
+import threading
+import weakref
+import numpy as np
+from collections import Counter, OrderedDict
+
+RESULT_CACHE_ENTRIES = 32 # result sets kept for paging, least recently used ones are dropped
+PAGE_SIZE = 90
+MASK_CACHE_BYTES = 256 << 20 # memory budget for the error masks of single assertions
+
+def hash_key(*parts) -> str:
+  return hashlib.sha1(json.dumps(parts, sort_keys=True).encode('utf-8')).hexdigest()
+
+class ResultSet:
+  # Rows of a /search or /check result: prediction ids in the PoseStore and the
+  # assertion that flagged each of them ('' for search results). The ids are only valid
+  # for the store they were computed on, which is kept as a weak reference.
+  def __init__(self, key: str, dataset: str, store, idx: np.ndarray, labels: 'list[str]') -> None:
+    self.key_ = key
+    self.dataset_ = dataset
+    self.store_ = weakref.ref(store)
+    self.idx_ = np.asarray(idx, dtype=np.int64)
+    self.labels_ = labels
+    self.counts_ = dict(Counter(labels))
+
+  def key(self) -> str:
+    return self.key_
+
+  def dataset(self) -> str:
+    return self.dataset_
+
+  def store(self):
+    # None once the dataset was unloaded
+    return self.store_()
+
+  def length(self) -> int:
+    return len(self.idx_)
+
+  def page(self, offset: int, size: int) -> tuple([np.ndarray, 'list[str]']):
+    return self.idx_[offset:offset+size], self.labels_[offset:offset+size]
+
+  def counts(self) -> dict:
+    return self.counts_
+
+class ResultCache:
+  def __init__(self, max_entries: int = RESULT_CACHE_ENTRIES) -> None:
+    self.max_entries_ = max_entries
+    self.results_ = OrderedDict()
+    self.lock_ = threading.Lock()
+
+  @staticmethod
+  def key(*parts) -> str:
+    return hash_key(*parts)
+
+  def get(self, key: str, store=None) -> ResultSet:
+    # With a store, results computed on another version of the dataset are dropped
+    with self.lock_:
+      result = self.results_.get(key)
+      if result is None:
+        return None
+      if result.store() is None or (store is not None and result.store() is not store):
+        del self.results_[key]
+        return None
+      self.results_.move_to_end(key)
+      return result
+
+  def put(self, result: ResultSet) -> None:
+    with self.lock_:
+      self.results_[result.key()] = result
+      while len(self.results_) > self.max_entries_:
+        self.results_.popitem(last=False)
+
+  def invalidate(self, dataset: str) -> None:
+    # Called when the registry unloads a dataset
+    with self.lock_:
+      for key in [k for k, r in self.results_.items() if r.dataset() == dataset]:
+        del self.results_[key]
+
+class MaskCache:
+  # Error masks of single assertions over the predictions kept by a predicate filter, so
+  # a re-check only evaluates new or edited assertions. Entries keep a weak reference to
+  # the PoseStore they were computed on and are ignored once the dataset is reloaded.
+  def __init__(self, max_bytes: int = MASK_CACHE_BYTES) -> None:
+    self.max_bytes_ = max_bytes
+    self.masks_ = OrderedDict()
+    self.nbytes_ = 0
+    self.lock_ = threading.Lock()
+    self.hits_ = 0
+    self.misses_ = 0
+
+  @staticmethod
+  def key(*parts) -> str:
+    return hash_key(*parts)
+
+  def get(self, key: str, store) -> np.ndarray:
+    with self.lock_:
+      entry = self.masks_.get(key)
+      if entry is None or entry[0]() is not store:
+        self.misses_ += 1
+        return None
+      self.hits_ += 1
+      self.masks_.move_to_end(key)
+      return entry[1]
+
+  def put(self, key: str, store, mask: np.ndarray) -> None:
+    with self.lock_:
+      if key in self.masks_:
+        self.nbytes_ -= self.masks_.pop(key)[1].nbytes
+      self.masks_[key] = (weakref.ref(store), mask)
+      self.nbytes_ += mask.nbytes
+      while len(self.masks_) > 1 and self.nbytes_ > self.max_bytes_:
+        self.nbytes_ -= self.masks_.popitem(last=False)[1][1].nbytes
+
+  def stats(self) -> dict:
+    with self.lock_:
+      return {'hits': self.hits_, 'misses': self.misses_, 'entries': len(self.masks_),
+              'bytes': self.nbytes_, 'max_bytes': self.max_bytes_}
+
+def make_cursor(result: ResultSet, offset: int) -> str:
+  # None once every row has been served
+  if offset >= result.length():
+    return None
+  return result.key() + ':' + str(offset)
+
+def parse_cursor(cursor: str) -> tuple([str, int]):
+  try:
+    key, offset = cursor.split(':')
+    return key, max(0, int(offset))
+  except (AttributeError, ValueError):
+    return None, 0
@@ -1,4 +1,4 @@
-function addImage(canvasId, path, keypoints, bbox, asst_name){
+function addImage(canvasId, path, keypoints, bbox, asst_name, thumb){
   var canvas = document.getElementById(canvasId);
   var ctx = canvas.getContext("2d");
 
@@ -7,26 +7,31 @@ function addImage(canvasId, path, keypoints, bbox, asst_name){
 
   canvas.style["display"] = "inline";
   const image = new Image();
-  image.src = "./static/dataset/" + path;
+  // Server thumbnails are already cropped around the bbox with the skeleton drawn
+  image.src = thumb ? "http://localhost:5000" + thumb : "./static/dataset/" + path;
   image.style.width = 'auto';
   image.style.height = '300px';
   image.addEventListener('load', render);
   var frame_num = path.split("thumb")[1].split(".")[0]
 
   function render() {
-    const newx = (200 - bbox[2])/2;
-    const newy = (300 - bbox[3])/2;
-
-    ctx.drawImage(image,bbox[0]-newx,bbox[1]-newy,canvas.width,canvas.height,0,0,canvas.width,canvas.height);
-
-    for (let i = 0; i < keypoints.length; i++){
-      if (i > 0) ctx.beginPath();
-      k = keypoints[i];
-      ctx.moveTo(k[0]+newx, k[1]+newy);
-      ctx.lineTo(k[2]+newx, k[3]+newy);
-      ctx.lineWidth = 2;
-      ctx.strokeStyle = `rgb(${Math.floor(255 * k[4][0])},${Math.floor(255 * k[4][1])},${Math.floor(255 * k[4][2])})`
-      ctx.stroke();
+    if (thumb) {
+      ctx.drawImage(image, 0, 0);
+    } else {
+      const newx = (200 - bbox[2])/2;
+      const newy = (300 - bbox[3])/2;
+
+      ctx.drawImage(image,bbox[0]-newx,bbox[1]-newy,canvas.width,canvas.height,0,0,canvas.width,canvas.height);
+
+      for (let i = 0; i < keypoints.length; i++){
+        if (i > 0) ctx.beginPath();
+        k = keypoints[i];
+        ctx.moveTo(k[0]+newx, k[1]+newy);
+        ctx.lineTo(k[2]+newx, k[3]+newy);
+        ctx.lineWidth = 2;
+        ctx.strokeStyle = `rgb(${Math.floor(255 * k[4][0])},${Math.floor(255 * k[4][1])},${Math.floor(255 * k[4][2])})`
+        ctx.stroke();
+      }
     }
     ctx.font = '12px sans-serif';
     ctx.fillStyle = 'rgb(0, 255, 255)';
@@ -76,46 +81,141 @@ function addFrameGroup(frame_id, areaId){
   document.getElementById(areaId).innerHTML +=base_html;
 }
 
-function loadData(images, keypoints, bbox, asst_name, areaId){
+function loadData(images, keypoints, bbox, asst_name, areaId, thumbs, offset = 0){
+  // offset keeps the canvas ids unique when a page is appended to the ones already shown
   for (let i = 0; i < images.length; i++) {
-    addFrameGroup("frame" + i.toString(), areaId);
+    addFrameGroup("frame" + (offset + i).toString(), areaId);
   }
   for (let i = 0; i < images.length; i++) {
-    addImage("frame" + i.toString() + "1_" + areaId, images[i][0], keypoints[i][0], bbox[i][0], asst_name[i]);
-    addImage("frame" + i.toString() + "2_" + areaId, images[i][1], keypoints[i][1], bbox[i][1], asst_name[i]);
-    addImage("frame" + i.toString() + "3_" + areaId, images[i][2], keypoints[i][2], bbox[i][2], asst_name[i]);
+    const t = thumbs ? thumbs[i] : [null, null, null];
+    const id = "frame" + (offset + i).toString();
+    addImage(id + "1_" + areaId, images[i][0], keypoints[i][0], bbox[i][0], asst_name[i], t[0]);
+    addImage(id + "2_" + areaId, images[i][1], keypoints[i][1], bbox[i][1], asst_name[i], t[1]);
+    addImage(id + "3_" + areaId, images[i][2], keypoints[i][2], bbox[i][2], asst_name[i], t[2]);
   }
 }
 
+// Cursor of the next page and number of results already shown in every image area
+var pages = {
+  imageArea: {path: "http://localhost:5000/search", cursor: null, loaded: 0},
+  imageAreaAssertions: {path: "http://localhost:5000/check", cursor: null, loaded: 0}
+};
+
+function resetPages(areaId){
+  pages[areaId].cursor = null;
+  pages[areaId].loaded = 0;
+  document.getElementById("more_" + areaId).className = "btn btn-secondary hidden_content";
+}
+
+function loadMore(areaId){
+  if (!pages[areaId].cursor) return;
+  var httpPost = new XMLHttpRequest(),
+  data = JSON.stringify({cursor: pages[areaId].cursor});
+  httpPost.responseType = 'json';
+  httpPost.open("POST", pages[areaId].path, true);
+  httpPost.setRequestHeader('Content-Type', 'application/json');
+  httpPost.send(data);
+
+  httpPost.onreadystatechange = function(err) {
+    if (httpPost.readyState == 4 && httpPost.status == 200){
+      const data = httpPost.response;
+      if (data['error'] == true){
+        // The result set was dropped from the server cache, the query has to be run again
+        resetPages(areaId);
+        return;
+      }
+      appendRows(data, areaId);
+      setCursor(data['cursor'], areaId);
+    } else {
+        console.log(err);
+    }
+  };
+}
+
 function decode(html) {
   var txt = document.createElement("textarea");
   txt.innerHTML = html;
   return txt.value;
 }
 
+function selectedDataset(){
+  return document.getElementById("datasetSelect").value;
+}
+
+function loadDatasets(){
+  var httpGet = new XMLHttpRequest(),
+  path = "http://localhost:5000/datasets";
+  httpGet.responseType = 'json';
+  httpGet.open("GET", path, true);
+  httpGet.send();
+
+  httpGet.onreadystatechange = function(err) {
+    if (httpGet.readyState == 4 && httpGet.status == 200){
+      const data = httpGet.response;
+      var select = document.getElementById("datasetSelect");
+      select.innerHTML = "";
+      for (const name of data['datasets']) {
+        var option = document.createElement("option");
+        option.value = name;
+        option.text = name;
+        option.selected = name == data['default'];
+        select.appendChild(option);
+      }
+    }
+  };
+}
+
+loadDatasets();
+
+function postStream(path, payload, onEvent){
+  // Streamed /search and /check answer with one json event per line (NDJSON),
+  // every event is handled as soon as its line is complete
+  payload.stream = true;
+  fetch(path, {method: "POST", headers: {'Content-Type': 'application/json'}, body: JSON.stringify(payload)})
+  .then(async function(response) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    var buffer = "";
+    while (true) {
+      const {done, value} = await reader.read();
+      if (done) break;
+      buffer += decoder.decode(value, {stream: true});
+      const lines = buffer.split("\n");
+      buffer = lines.pop();
+      for (const line of lines) {
+        if (line) onEvent(JSON.parse(line));
+      }
+    }
+  })
+  .catch(function(err) {
+    console.log(err);
+  });
+}
+
+function appendRows(data, areaId){
+  loadData(data['images'], data['keypoints'], data['bbox'], data['asst_names'], areaId, data['thumbs'], pages[areaId].loaded);
+  pages[areaId].loaded += data['images'].length;
+}
+
+function setCursor(cursor, areaId){
+  pages[areaId].cursor = cursor;
+  document.getElementById("more_" + areaId).className = cursor ? "btn btn-secondary" : "btn btn-secondary hidden_content";
+}
+
 function sendSelectionToServer(checkbox, batches, frames){
-var httpPost = new XMLHttpRequest(),
-path = "http://localhost:5000/search",
-data = JSON.stringify({checkbox: checkbox, batches: batches, frames: frames});
-httpPost.responseType = 'json';
-httpPost.open("POST", path, true);
-httpPost.setRequestHeader('Content-Type', 'application/json');
-httpPost.send(data);
-document.getElementById("imageArea").innerHTML = "";
-
-httpPost.onreadystatechange = function(err) {
-    if (httpPost.readyState == 4 && httpPost.status == 200){
-        const data = httpPost.response;
-        const err = data['error']
-        if (err == true){
-          document.getElementById('search_filt').className = "alert alert-warning alert-dismissible fade show";
-          return;
-        }
-        loadData(data['images'],data['keypoints'], data['bbox'], data['asst_names'], "imageArea");
+  document.getElementById("imageArea").innerHTML = "";
+  resetPages("imageArea");
+
+  const payload = {dataset: selectedDataset(), checkbox: checkbox, batches: batches, frames: frames, page_size: 90};
+  postStream("http://localhost:5000/search", payload, function(data) {
+    if (data['event'] == "rows"){
+      appendRows(data, "imageArea");
+    } else if (data['error'] == true){
+      document.getElementById('search_filt').className = "alert alert-warning alert-dismissible fade show";
     } else {
-        console.log(err);
+      setCursor(data['cursor'], "imageArea");
     }
-  };
+  });
 };
 
 function searchClicked(){
@@ -185,61 +285,61 @@ function checkClicked(){
 }
 
 function sendAssertionsToServer(assertions, checkbox){
-  var httpPost = new XMLHttpRequest(),
-  path = "http://localhost:5000/check",
-  data = JSON.stringify({assertions: assertions, checkbox: checkbox});
-  httpPost.responseType = 'json';
-  httpPost.open("POST", path, true);
-  httpPost.setRequestHeader('Content-Type', 'application/json');
-  httpPost.send(data);
-
   document.getElementById("imageAreaAssertions").innerHTML = "";
+  resetPages("imageAreaAssertions");
   document.getElementById('resTable').className = "table hidden_content";
   document.getElementById("tableBody").innerHTML = "";
   document.getElementById("loadSpinner").className = "spinner-border"
-  
-  httpPost.onreadystatechange = function(err) {
-    if (httpPost.readyState == 4 && httpPost.status == 200){
-      document.getElementById("loadSpinner").className = "spinner-border hidden_content"
-      const data = httpPost.response;
-      console.log(data);
-      const err = data['error']
-      if (err == true){
-        document.getElementById('asst_syntax').className = "alert alert-warning alert-dismissible fade show";
-        return;
-      }
-      if (data["images"].length == 0){
-        document.getElementById('asst_empty').className = "alert alert-warning alert-dismissible fade show";
-        return;
-      }
-      displayTable(data["asst_names"]);
-      loadData(data['images'].slice(0, 90),data['keypoints'].slice(0, 90), data['bbox'].slice(0, 90), data["asst_names"].slice(0, 90), "imageAreaAssertions");
-    } else {
-        console.log(err);
+
+  const payload = {dataset: selectedDataset(), assertions: assertions, checkbox: checkbox, page_size: 90};
+  postStream("http://localhost:5000/check", payload, function(data) {
+    if (data['event'] == "rows"){
+      appendRows(data, "imageAreaAssertions");
+      return;
     }
-  };
+    // The summary closes the stream
+    document.getElementById("loadSpinner").className = "spinner-border hidden_content"
+    console.log(data);
+    if (data['error'] == true){
+      showSyntaxError(data);
+      return;
+    }
+    if (data['total'] == 0){
+      document.getElementById('asst_empty').className = "alert alert-warning alert-dismissible fade show";
+      return;
+    }
+    displayTable(data["counts"]);
+    setCursor(data['cursor'], "imageAreaAssertions");
+  });
 };
 
+function showSyntaxError(data){
+  // DSL errors come with the line and column where the assertions stop making sense
+  var msg = "Check your assertions syntax.";
+  if (data['message']){
+    msg = data['message'];
+    if (data['line']){
+      msg += " (line " + data['line'] + ", column " + data['column'] + ")";
+      editor.focus();
+      editor.setCursor(data['line'] - 1, data['column'] - 1);
+    }
+  }
+  document.getElementById('asst_syntax_msg').textContent = msg;
+  document.getElementById('asst_syntax').className = "alert alert-warning alert-dismissible fade show";
+}
+
 function hideAlert(){
   document.getElementById('asst_syntax').className = "alert alert-warning alert-dismissible fade show hidden_content";
   document.getElementById('asst_empty').className = "alert alert-warning alert-dismissible fade show hidden_content";
   document.getElementById('search_filt').className = "alert alert-warning alert-dismissible fade show hidden_content";
 }
 
-function displayTable(asst_names){
+function displayTable(counts){
+  // Counts cover the whole result set, not only the pages loaded so far
   document.getElementById('resTable').className = "table";
   var table_content = document.getElementById("tableBody");
 
-  const output = asst_names.reduce(function (acc, curr) {
-    if (acc[curr]) {
-        acc[curr] = ++acc[curr];
-    } else {
-        acc[curr] = 1;
-    }
-    return acc;
-  }, {});
-
-  for (const [key, value] of Object.entries(output)) {
+  for (const [key, value] of Object.entries(counts)) {
     const base_html = `
     <tr>
       <th scope="row">${key}</th>
@@ -0,0 +1,118 @@
+import os
+import sys
+import json
+import argparse
+import numpy as np
+
+from data_utils import W, H, PoseTrack_COCO_Keypoint_Ordering
+
+# Standing person seen from the front, keypoints relative to its bbox (x/w, y/h)
+SKELETON = {
+  'nose': (0.5, 0.08), 'head_bottom': (0.5, 0.15), 'head_top': (0.5, 0.0),
+  'left_ear': (0.56, 0.07), 'right_ear': (0.44, 0.07),
+  'left_shoulder': (0.68, 0.2), 'right_shoulder': (0.32, 0.2),
+  'left_elbow': (0.75, 0.36), 'right_elbow': (0.25, 0.36),
+  'left_wrist': (0.78, 0.5), 'right_wrist': (0.22, 0.5),
+  'left_hip': (0.62, 0.52), 'right_hip': (0.38, 0.52),
+  'left_knee': (0.63, 0.75), 'right_knee': (0.37, 0.75),
+  'left_ankle': (0.64, 0.98), 'right_ankle': (0.36, 0.98),
+}
+TEMPLATE = np.array([SKELETON[kp] for kp in PoseTrack_COCO_Keypoint_Ordering])
+MIRROR = [PoseTrack_COCO_Keypoint_Ordering.index(kp.replace('left_', '#').replace('right_', 'left_').replace('#', 'right_'))
+          for kp in PoseTrack_COCO_Keypoint_Ordering]
+
+GENERATOR_VERSION = 2 # bumped whenever the same parameters and seed produce a different dataset
+ERROR_KINDS = ['swap', 'jump'] # left/right sides exchanged, one keypoint far from its neighbors in time
+ASPECT = 0.4 # bbox width / height
+
+def generate(num_frames: int, persons=10, motion=4.0, jitter=0.01, error_rate=0.01, gap_rate=0.02,
+             dropout=0.02, min_height=80, max_height=400, seed=0):
+  # Yields (frame_number, people, injected) per frame in the .pose.json layout. injected lists
+  # (person, kind) for the labelling errors of the frame. The same seed gives the same dataset.
+  rng = np.random.RandomState(seed)
+  heights = rng.uniform(min_height, max_height, persons)
+  positions = np.stack([rng.uniform(0, W - heights*ASPECT), rng.uniform(0, H - heights)], axis=1)
+  velocity = rng.normal(0, motion, (persons, 2))
+
+  frame_number = 1
+  for f in range(num_frames):
+    # People walk with a slowly changing velocity, at most 2*motion along each axis, and
+    # bounce on the borders of the frame
+    velocity = np.clip(velocity + rng.normal(0, motion/10, velocity.shape), -2*motion, 2*motion)
+    positions += velocity
+    size = np.stack([heights*ASPECT, heights], axis=1)
+    limit = np.array([W, H]) - size
+    out = (positions < 0) | (positions > limit)
+    velocity[out] *= -1
+    positions = np.clip(positions, 0, limit)
+
+    visible = np.flatnonzero(rng.random_sample(persons) >= dropout)
+    errors = rng.random_sample(len(visible)) < error_rate
+    kinds = rng.randint(len(ERROR_KINDS), size=len(visible))
+
+    kps = TEMPLATE[None] + rng.normal(0, jitter, (len(visible), len(TEMPLATE), 2))
+    people = []
+    injected = []
+    for j, p in enumerate(visible):
+      pose = kps[j]
+      if errors[j]:
+        kind = ERROR_KINDS[kinds[j]]
+        injected.append((j, kind))
+        if kind == 'swap':
+          pose = pose[MIRROR]
+        else:
+          pose = pose.copy()
+          pose[rng.randint(len(pose))] += rng.choice([-1, 1], 2) * 0.6
+
+      x, y = positions[p]
+      w, h = size[p]
+      xy = np.rint(pose * [w, h] + [x, y]).astype(int)
+      scores = np.round(rng.uniform(0.3, 1.0, len(pose)), 3)
+      people.append({'score': round(float(scores.mean()), 3), 'xywh': [int(x), int(y), int(w), int(h)],
+                     'pose': [[[int(a), int(b), float(s)] for (a, b), s in zip(xy, scores)]]})
+
+    yield frame_number, people, injected
+    frame_number += 1 + (rng.random_sample() < gap_rate)
+
+def write_dataset(json_path: str, num_frames: int, **kwargs) -> dict:
+  # Frames are written one at a time, so datasets larger than memory can be produced.
+  # Injected errors are saved next to the dataset as <name>.injected.json.
+  os.makedirs(os.path.dirname(json_path) or '.', exist_ok=True)
+  predictions = 0
+  injected = []
+  with open(json_path, 'w') as f:
+    f.write('{"person": [')
+    for i, (frame_number, people, errors) in enumerate(generate(num_frames, **kwargs)):
+      f.write((',' if i else '') + json.dumps([frame_number, people]))
+      injected.extend([i, person, kind] for person, kind in errors)
+      predictions += len(people)
+    f.write(']}')
+
+  info = {'frames': num_frames, 'predictions': predictions, 'injected': injected, 'params': kwargs, 'generator': GENERATOR_VERSION}
+  with open(json_path[:-len('.pose.json')] + '.injected.json', 'w') as f:
+    json.dump(info, f)
+  return info
+
+def frames_for(predictions: int, persons: int, dropout: float) -> int:
+  return int(np.ceil(predictions / max(persons*(1 - dropout), 1e-9)))
+
+if __name__ == '__main__':
+  # python synthetic.py ./static/dataset/SYN/SYN.pose.json --predictions 100000
+  parser = argparse.ArgumentParser(description='Write a deterministic synthetic .pose.json dataset.')
+  parser.add_argument('json_path')
+  parser.add_argument('--frames', type=int, help='number of frames (default: enough for --predictions)')
+  parser.add_argument('--predictions', type=int, default=10000)
+  parser.add_argument('--persons', type=int, default=10, help='people per frame')
+  parser.add_argument('--motion', type=float, default=4.0, help='typical speed, in pixels per frame')
+  parser.add_argument('--error-rate', type=float, default=0.01, help='fraction of predictions with an injected labelling error')
+  parser.add_argument('--gap-rate', type=float, default=0.02, help='probability of skipping a frame number')
+  parser.add_argument('--dropout', type=float, default=0.02, help='probability of a person missing from a frame')
+  parser.add_argument('--seed', type=int, default=0)
+  args = parser.parse_args()
+
+  if not args.json_path.endswith('.pose.json'):
+    parser.error('the dataset must be a .pose.json file')
+  frames = args.frames or frames_for(args.predictions, args.persons, args.dropout)
+  info = write_dataset(args.json_path, frames, persons=args.persons, motion=args.motion, error_rate=args.error_rate,
+                       gap_rate=args.gap_rate, dropout=args.dropout, seed=args.seed)
+  print('{}: {} frames, {} predictions, {} injected errors'.format(args.json_path, info['frames'], info['predictions'], len(info['injected'])), file=sys.stderr)
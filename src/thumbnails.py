@@ -0,0 +1,147 @@
+import os
+import json
+import hashlib
+import threading
+import cv2
+import numpy as np
+
+from data_utils import Prediction
+from viz import BONE_COLORS, LINE_WIDTH, get_image_data_from_video
+
+THUMB_WIDTH = 200
+THUMB_HEIGHT = 300
+THUMB_QUALITY = 85
+THUMB_CACHE_MAX_BYTES = 1 << 30 # disk budget of the thumbnail cache
+THUMB_CACHE_PRUNE_TO = 0.9 # fraction of the budget kept by a pruning, so it does not run on every write
+
+class ThumbnailCache:
+  # On-disk cache of encoded thumbnails. Files are addressed by the hash of everything
+  # the thumbnail is computed from, so an entry never needs to be invalidated and the
+  # same hash can be used as a strong ETag. Beyond max_bytes the least recently used
+  # files are deleted, a hit refreshes the mtime of its file.
+  def __init__(self, root: str, max_bytes: int = THUMB_CACHE_MAX_BYTES) -> None:
+    self.root_ = root if root.endswith('/') else root + '/'
+    self.max_bytes_ = max_bytes
+    self.lock_ = threading.Lock()
+    self.bytes_ = sum(size for _, _, size in self.files())
+
+  def key(self, *parts) -> str:
+    return hashlib.sha1(json.dumps(parts, sort_keys=True).encode('utf-8')).hexdigest()
+
+  def path(self, key: str) -> str:
+    return self.root_ + key[:2] + '/' + key + '.jpg'
+
+  def files(self) -> 'list[tuple[float, str, int]]':
+    # (mtime, path, size) of every cached thumbnail
+    found = []
+    if not os.path.isdir(self.root_):
+      return found
+    for entry in os.scandir(self.root_):
+      if not entry.is_dir():
+        continue
+      for f in os.scandir(entry.path):
+        if f.name.endswith('.jpg'):
+          try:
+            st = f.stat()
+          except OSError:
+            continue
+          found.append((st.st_mtime, f.path, st.st_size))
+    return found
+
+  def size(self) -> int:
+    return self.bytes_
+
+  def get(self, key: str) -> bytes:
+    path = self.path(key)
+    try:
+      with open(path, 'rb') as f:
+        data = f.read()
+      os.utime(path)
+    except OSError:
+      return None
+    return data
+
+  def put(self, key: str, data: bytes) -> None:
+    path = self.path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + '.' + str(os.getpid()) + '.tmp'
+    with open(tmp, 'wb') as f:
+      f.write(data)
+    os.replace(tmp, path)
+
+    with self.lock_:
+      self.bytes_ += len(data)
+      if self.bytes_ > self.max_bytes_:
+        self.prune()
+
+  def prune(self) -> None:
+    # The sizes are read again from the disk, other processes may share the folder
+    files = sorted(self.files())
+    total = sum(size for _, _, size in files)
+    for _, path, size in files:
+      if total <= self.max_bytes_ * THUMB_CACHE_PRUNE_TO:
+        break
+      try:
+        os.remove(path)
+        total -= size
+      except OSError:
+        pass
+    self.bytes_ = total
+
+def frame_image_path(base_path: str, real_frame: int, extension: str) -> str:
+  # Same naming as the frames served to the browser: thumb<real frame + 1>
+  return os.path.dirname(base_path) + '/frames/thumb' + str(real_frame + 1).zfill(4) + extension
+
+def frame_source_version(base_path: str, real_frame: int, extension: str) -> list:
+  for path in (frame_image_path(base_path, real_frame, extension), base_path + '.mp4'):
+    if os.path.isfile(path):
+      st = os.stat(path)
+      return [path, st.st_size, st.st_mtime_ns]
+  return None
+
+def read_frame_image(base_path: str, real_frame: int, extension: str) -> np.array:
+  img = cv2.imread(frame_image_path(base_path, real_frame, extension), cv2.IMREAD_COLOR)
+  if img is None:
+    img = get_image_data_from_video(base_path, real_frame)
+  return img
+
+def render_thumbnail(pred: Prediction, image: np.array, skeleton=True) -> bytes:
+  # THUMB_WIDTH x THUMB_HEIGHT crop centered on the bbox, padded where it leaves the frame
+  x,y,w,h = pred.get_bbox()
+  x0 = int(x - (THUMB_WIDTH - w)/2)
+  y0 = int(y - (THUMB_HEIGHT - h)/2)
+
+  out = np.zeros((THUMB_HEIGHT, THUMB_WIDTH, 3), dtype=np.uint8)
+  sx0, sy0 = max(x0, 0), max(y0, 0)
+  sx1, sy1 = min(x0 + THUMB_WIDTH, image.shape[1]), min(y0 + THUMB_HEIGHT, image.shape[0])
+  if sx1 > sx0 and sy1 > sy0:
+    out[sy0-y0:sy1-y0, sx0-x0:sx1-x0] = image[sy0:sy1, sx0:sx1, :3]
+
+  if skeleton:
+    keypoints = pred.get_keypoints()
+    for ind_1, ind_2, color in BONE_COLORS:
+      x1, y1 = keypoints[ind_1].position()
+      x2, y2 = keypoints[ind_2].position()
+      cv2.line(out, (int(x1-x0), int(y1-y0)), (int(x2-x0), int(y2-y0)), color, LINE_WIDTH, cv2.LINE_AA)
+
+  ok, buf = cv2.imencode('.jpg', out, [cv2.IMWRITE_JPEG_QUALITY, THUMB_QUALITY])
+  if not ok:
+    raise RuntimeError('Could not encode thumbnail')
+  return buf.tobytes()
+
+def thumbnail_key(cache: ThumbnailCache, name: str, base_path: str, pred: Prediction, extension: str, skeleton=True) -> str:
+  # None when neither the frame image nor the video exist
+  source = frame_source_version(base_path, pred.get_real_frame_number(), extension)
+  if source is None:
+    return None
+
+  keypoints = [kp.position() for kp in pred.get_keypoints().values()] if skeleton else None
+  return cache.key(name, source, pred.get_bbox(), keypoints, skeleton, THUMB_WIDTH, THUMB_HEIGHT, THUMB_QUALITY)
+
+def get_thumbnail(cache: ThumbnailCache, key: str, base_path: str, pred: Prediction, extension: str, skeleton=True) -> bytes:
+  data = cache.get(key)
+  if data is None:
+    image = read_frame_image(base_path, pred.get_real_frame_number(), extension)
+    data = render_thumbnail(pred, image, skeleton)
+    cache.put(key, data)
+  return data
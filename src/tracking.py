@@ -0,0 +1,85 @@
+import numpy as np
+
+TRACK_MIN_IOU = 0.3 # smallest bbox IoU for two predictions of consecutive frames to be the same person
+TRACK_MAX_GAP = 3 # largest difference of real frame numbers between two linked predictions
+TRACK_CHUNK_FRAMES = 4096 # frame pairs matched at once, bounds the candidate pairs held in memory
+
+def box_iou(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+  # Element-wise IoU of two arrays of xywh boxes
+  a = a.astype(np.float64)
+  b = b.astype(np.float64)
+  w = np.minimum(a[:, 0] + a[:, 2], b[:, 0] + b[:, 2]) - np.maximum(a[:, 0], b[:, 0])
+  h = np.minimum(a[:, 1] + a[:, 3], b[:, 1] + b[:, 3]) - np.maximum(a[:, 1], b[:, 1])
+  inter = np.clip(w, 0, None) * np.clip(h, 0, None)
+  union = a[:, 2]*a[:, 3] + b[:, 2]*b[:, 3] - inter
+  return np.where(union > 0, inter / np.where(union > 0, union, 1), 0)
+
+def frame_pairs(frame_offsets: np.ndarray, start: int, stop: int) -> 'tuple[np.ndarray, np.ndarray]':
+  # Every (a, b) with a in relative frame f and b in frame f+1, for f in [start, stop)
+  counts = np.diff(frame_offsets)
+  frames = np.repeat(np.arange(start, stop), counts[start:stop])
+  next_counts = counts[frames + 1]
+  a = np.repeat(np.arange(frame_offsets[start], frame_offsets[stop]), next_counts)
+  first = np.repeat(np.cumsum(next_counts) - next_counts, next_counts)
+  b = np.repeat(frame_offsets[frames + 1], next_counts) + np.arange(len(a)) - first
+  return a, b
+
+def first_occurrences(values: np.ndarray) -> np.ndarray:
+  mask = np.zeros(len(values), dtype=bool)
+  mask[np.unique(values, return_index=True)[1]] = True
+  return mask
+
+def greedy_match(a: np.ndarray, b: np.ndarray, iou: np.ndarray) -> 'tuple[np.ndarray, np.ndarray]':
+  # Same result as taking the pairs by decreasing IoU and skipping those with an end already
+  # matched, but in a few vectorized rounds: a pair that is the best remaining one of both
+  # its ends is always taken by the greedy matching.
+  keep = iou >= TRACK_MIN_IOU
+  a, b, iou = a[keep], b[keep], iou[keep]
+  order = np.lexsort((b, a, -iou))
+  a, b = a[order], b[order]
+
+  matched_a = []
+  matched_b = []
+  while len(a):
+    best = first_occurrences(a) & first_occurrences(b)
+    matched_a.append(a[best])
+    matched_b.append(b[best])
+    keep = ~(np.isin(a, a[best]) | np.isin(b, b[best]))
+    a, b = a[keep], b[keep]
+
+  empty = np.zeros(0, dtype=np.int64)
+  return np.concatenate(matched_a + [empty]), np.concatenate(matched_b + [empty])
+
+def tracks_from_links(prev: np.ndarray) -> 'tuple[np.ndarray, np.ndarray]':
+  # prev: previous prediction of the same person, -1 at the start of a track. Returns the
+  # tracks in CSR layout: the predictions of track t are track_predictions[track_offsets[t]:track_offsets[t+1]]
+  ids = np.arange(len(prev))
+  root = np.where(prev >= 0, prev, ids)
+  while True:
+    up = root[root]
+    if np.array_equal(up, root):
+      break
+    root = up
+
+  # Prediction ids grow with the frame, so a stable sort keeps every track in time order
+  track_predictions = np.argsort(root, kind='stable')
+  counts = np.unique(root, return_counts=True)[1]
+  track_offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+  return track_offsets, track_predictions.astype(np.int64)
+
+def link_tracks(frame_numbers: np.ndarray, frame_offsets: np.ndarray, bboxes: np.ndarray) -> 'tuple[np.ndarray, np.ndarray]':
+  # Greedy bbox IoU matching between every pair of consecutive relative frames. Frames too far
+  # apart in the video are not linked, so real frame numbers strictly grow along a track.
+  num_frames = len(frame_offsets) - 1
+  gaps = np.diff(frame_numbers)
+  linkable = (gaps >= 1) & (gaps <= TRACK_MAX_GAP)
+  pred_frame = np.repeat(np.arange(num_frames), np.diff(frame_offsets))
+
+  prev = np.full(len(bboxes), -1, dtype=np.int64)
+  for start in range(0, max(num_frames - 1, 0), TRACK_CHUNK_FRAMES):
+    stop = min(start + TRACK_CHUNK_FRAMES, num_frames - 1)
+    a, b = frame_pairs(frame_offsets, start, stop)
+    keep = linkable[pred_frame[a]]
+    a, b = greedy_match(a[keep], b[keep], box_iou(bboxes[a[keep]], bboxes[b[keep]]))
+    prev[b] = a
+  return tracks_from_links(prev)
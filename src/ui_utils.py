@@ -1,14 +1,16 @@
 import io
 import numpy as np
 from enum import Enum
-from scipy.spatial import distance
 import pandas as pd
 
-from data_utils import Prediction, get_prediction, H
+from data_utils import Prediction, PoseStore, H, FPS
 from assertions import Assertion, AssertionChecker, AssertionFunction
-from viz import get_prediction_vis, get_image_data_from_video
+from metrics import stage
+from viz import render_predictions, get_images_data_from_video
 
 MIN_DIST_FAST_SPEED = 0.05 # 5% of the bbox height displacement per frame
+STATS_SAMPLE = 4096 # predictions sampled to estimate how selective every condition is
+CONDITION_COST = {'spatial': 1, 'temporal': 12} # relative cost per prediction, temporal ones look up two neighbors
 
 class Frame:
   def __init__(self, data: io.BytesIO, width: int, height: int, prediction: Prediction) -> None:
@@ -86,7 +88,7 @@ class Condition(Enum):
       if item.value[0] == name: return item
 
 class ConditionChecker:
-  def __init__(self, dataset) -> None:
+  def __init__(self, dataset: PoseStore) -> None:
     self.condition_ = None
     self.predictions_ = None
     self.dataset_ = dataset
@@ -97,169 +99,156 @@ class ConditionChecker:
   def set_predictions(self, predictions: 'list[Prediction]') -> None:
     self.predictions_ = predictions
 
-  def check(self, value=None):
-    if self.condition_ == Condition.DIRECTION_RIGHT:
-        return self.__check_direction_right()
-    elif self.condition_ == Condition.DIRECTION_LEFT:
-      return self.__check_direction_left()
-    elif self.condition_ == Condition.SPEED_FAST:
-      return self.__check_speed_fast()
-    elif self.condition_ == Condition.SPEED_SLOW:
-      return self.__check_speed_slow()
-    elif self.condition_ == Condition.MIN_SIZE:
-      return self.__check_min_size(value)
-    elif self.condition_ == Condition.MAX_SIZE:
-      return self.__check_max_size(value)
+  def check(self, value=None) -> 'list[Prediction]':
+    idx = np.array([p.get_index() for p in self.predictions_], dtype=np.int64)
+    keep = self.mask(self.condition_, value, idx)
+    return [p for p, k in zip(self.predictions_, keep) if k]
+
+  def mask(self, condition: Condition, value=None, idx: np.ndarray = None) -> np.ndarray:
+    # Boolean column of the condition for the predictions in idx (all predictions if None)
+    if idx is None:
+      idx = np.arange(self.dataset_.num_predictions())
+
+    if condition.ctype == 'temporal':
+      return self.__temporal_mask(condition, idx)
+
+    heights = self.dataset_.bboxes_[idx, 3]
+    if condition == Condition.MIN_SIZE:
+      return heights > H*value/100
+    elif condition == Condition.MAX_SIZE:
+      return heights < H*value/100
+    else:
+      raise RuntimeError('Error. Non-existing condition')
+
+  def __temporal_mask(self, condition: Condition, idx: np.ndarray) -> np.ndarray:
+    prev = self.dataset_.prev_index()[idx]
+    next = self.dataset_.next_index()[idx]
+    valid = (prev >= 0) & (next >= 0)
+    bboxes = self.dataset_.bboxes_
+
+    if condition in (Condition.DIRECTION_RIGHT, Condition.DIRECTION_LEFT):
+      x, x1, x3 = [bboxes[i, 0].astype(np.float64) for i in (idx, prev, next)]
+      if condition == Condition.DIRECTION_RIGHT:
+        return valid & (x1 < x) & (x < x3)
+      return valid & (x1 > x) & (x > x3)
+
+    elif condition in (Condition.SPEED_FAST, Condition.SPEED_SLOW):
+      b, b1, b3 = [bboxes[i].astype(np.float64) for i in (idx, prev, next)]
+      center, center1, center3 = [v[:, :2] + v[:, 2:] // 2 for v in (b, b1, b3)]
+      # Displacement per real frame, neighbors can be a few frames away when frames were dropped
+      f, f1, f3 = [self.dataset_.real_frames(i) for i in (idx, prev, next)]
+      dist1 = np.linalg.norm(center - center1, axis=1) / np.maximum(f - f1, 1)
+      dist3 = np.linalg.norm(center - center3, axis=1) / np.maximum(f3 - f, 1)
+      min_dist = MIN_DIST_FAST_SPEED * b[:, 3]
+      if condition == Condition.SPEED_FAST:
+        return valid & (dist1 > min_dist) & (dist3 > min_dist)
+      return valid & (dist1 < min_dist) & (dist3 < min_dist)
+
     else:
       raise RuntimeError('Error. Non-existing condition')
 
+class ConditionPlanner:
+  # Orders the conditions of a search so cheap and selective ones run first. The fraction
+  # of predictions passing every condition is estimated on an evenly spaced sample of the
+  # dataset; the sample and the temporal estimates are computed once per dataset.
+  def __init__(self, dataset: PoseStore, checker: ConditionChecker) -> None:
+    self.dataset_ = dataset
+    self.checker_ = checker
+
+  def sample(self) -> np.ndarray:
+    n = self.dataset_.num_predictions()
+    return self.dataset_.column('stats_sample', lambda: np.unique(np.linspace(0, n - 1, min(n, STATS_SAMPLE)).astype(np.int64)))
+
+  def selectivity(self, condition: Condition, value=None) -> float:
+    if condition.ctype == 'temporal':
+      passed = self.dataset_.column('stats_' + condition.name, lambda: self.checker_.mask(condition, None, self.sample()))
+    else:
+      passed = self.checker_.mask(condition, value, self.sample())
+    return float(passed.mean()) if len(passed) else 1.0
+
+  def cost(self, condition: Condition) -> float:
+    return CONDITION_COST[condition.ctype]
 
-  def __check_direction_right(self):
-    out = []
-    for pred in self.predictions_:
-      prev = get_prediction(self.dataset_, pred.get_relative_frame_number() - 1, pred.get_person())
-      next = get_prediction(self.dataset_, pred.get_relative_frame_number() + 1, pred.get_person())
-
-      if prev == None or next == None:
-        continue
-      
-      if prev.get_bbox()[0] < pred.get_bbox()[0] and pred.get_bbox()[0] < next.get_bbox()[0]:
-        out.append(pred)
-
-    return out
-
-  def __check_direction_left(self):
-    out = []
-    for pred in self.predictions_:
-      prev = get_prediction(self.dataset_, pred.get_relative_frame_number() - 1, pred.get_person())
-      next = get_prediction(self.dataset_, pred.get_relative_frame_number() + 1, pred.get_person())
-
-      if prev == None or next == None:
-        continue
-      
-      if prev.get_bbox()[0] > pred.get_bbox()[0] and pred.get_bbox()[0] > next.get_bbox()[0]:
-        out.append(pred)
-
-    return out
-
-  def __check_speed_fast(self):
-    out = []
-    for pred in self.predictions_:
-      pred_bbox = pred.get_bbox()
-      prev = get_prediction(self.dataset_, pred.get_relative_frame_number() - 1, pred.get_person())
-      next = get_prediction(self.dataset_, pred.get_relative_frame_number() + 1, pred.get_person())
-
-      if prev == None or next == None:
-        continue
-
-      prev = prev.get_bbox()
-      next = next.get_bbox()
-
-      dist1 = abs(distance.cdist([[pred_bbox[0] + pred_bbox[2]//2, pred_bbox[1] + pred_bbox[3]//2]], [[prev[0] + prev[2]//2, prev[1] + prev[3]//2]], 'euclidean')[0][0])
-      dist3 = abs(distance.cdist([[pred_bbox[0] + pred_bbox[2]//2, pred_bbox[1] + pred_bbox[3]//2]], [[next[0] + next[2]//2, next[1] + next[3]//2]], 'euclidean')[0][0])
-      
-      if dist1 > MIN_DIST_FAST_SPEED * pred_bbox[3] and dist3 > MIN_DIST_FAST_SPEED * pred_bbox[3]:
-        out.append(pred)
-
-    return out
-
-  def __check_speed_slow(self):
-    out = []
-    for pred in self.predictions_:
-      pred_bbox = pred.get_bbox()
-      prev = get_prediction(self.dataset_, pred.get_relative_frame_number() - 1, pred.get_person())
-      next = get_prediction(self.dataset_, pred.get_relative_frame_number() + 1, pred.get_person())
-
-      if prev == None or next == None:
-        continue
-
-      prev = prev.get_bbox()
-      next = next.get_bbox()
-
-      dist1 = abs(distance.cdist([[pred_bbox[0] + pred_bbox[2]//2, pred_bbox[1] + pred_bbox[3]//2]], [[prev[0] + prev[2]//2, prev[1] + prev[3]//2]], 'euclidean')[0][0])
-      dist3 = abs(distance.cdist([[pred_bbox[0] + pred_bbox[2]//2, pred_bbox[1] + pred_bbox[3]//2]], [[next[0] + next[2]//2, next[1] + next[3]//2]], 'euclidean')[0][0])
-      
-      if dist1 < MIN_DIST_FAST_SPEED * pred_bbox[3] and dist3 < MIN_DIST_FAST_SPEED * pred_bbox[3]:
-        out.append(pred)
-
-    return out
-
-  def __check_min_size(self, val):
-    out = []
-    for pred in self.predictions_:
-      if pred.get_bbox()[-1] > H*val/100:
-        out.append(pred)
-    return out
-
-  def __check_max_size(self, val):
-    out = []
-    for pred in self.predictions_:
-      if pred.get_bbox()[-1] < H*val/100:
-        out.append(pred)
-    return out
+  def order(self, conditions: 'list[tuple]') -> 'list[tuple]':
+    # Classic filter ordering: ascending cost per prediction removed
+    def rank(cond):
+      condition, value = cond
+      removed = 1 - self.selectivity(condition, value)
+      return self.cost(condition) / removed if removed > 0 else np.inf
+    return sorted(conditions, key=rank)
 
 class Predicate:
-  def __init__(self, dataset: dict, filename: str, conditions: 'list[Condition]', num_batches: int, batch_size: int, include_display=False) -> None:
+  def __init__(self, dataset: PoseStore, filename: str, conditions: 'list[Condition]', num_batches: int, batch_size: int, include_display=False) -> None:
     self.path_ = '/'.join(filename.split('/')[:-1]) + '/'
     self.filename_ = filename.split('/')[-1]
     self.conditions_ = conditions
     self.dataset_ = dataset
-    self.time_between_batches_ = 3
-    self.FPS_ = 25
+    self.time_between_batches_ = 3 # seconds
+    self.FPS_ = FPS
     self.include_display_ = include_display
-    self.num_batches_ = num_batches if num_batches != 0 else len(dataset['person'])*2
+    self.num_batches_ = num_batches if num_batches != 0 else dataset.num_frames()*2
     self.batch_size_ = batch_size if batch_size != 0 else self.time_between_batches_* self.FPS_
   
   def run(self) -> 'list[Batch]':
-    out = []
+    return list(self.iter_batches())
+
+  def iter_batches(self):
+    # Batches are yielded as soon as they pass the conditions
+    out = 0
     lb = 0
+    cond_checker = ConditionChecker(self.dataset_)
+    conditions = ConditionPlanner(self.dataset_, cond_checker).order(self.conditions_)
 
-    while len(out) < self.num_batches_:
-      start = self.time_between_batches_* self.FPS_ * lb
+    # Batches are windows of real frame numbers, so dropped frames do not shift them
+    numbers, _ = self.dataset_.frame_index()
+    if len(numbers) == 0:
+      return
+    first, last = int(numbers[0]), int(numbers[-1])
+
+    while out < self.num_batches_:
+      start = first + self.time_between_batches_* self.FPS_ * lb
       end = start + self.batch_size_
-      batch_frames = np.arange(start, end, dtype=int)
-      if start > len(self.dataset_['person']) -1 or end > len(self.dataset_['person']) -1:
+      if start > last or end > last:
         break
      
       lb += 1
 
-      frames = []
- 
-      for f in batch_frames:
-        num_p = len(self.dataset_['person'][f][1])
-        for p in range(num_p):
-          pp = get_prediction(self.dataset_, f, p)
-          if pp:
-            frames.append(pp)
-
-      if frames:
-        cond_checker = ConditionChecker(self.dataset_)
-        cond_checker.set_predictions(frames)
-
-        for cond in self.conditions_:
-          condition, val = cond
-          cond_checker.set_condition(condition)
-          frames = cond_checker.check(val)
-          cond_checker.set_predictions(frames)
-          if frames is None:
+      # Every condition only sees the predictions that passed the previous ones
+      with stage('predicate') as s:
+        idx = self.dataset_.predictions_between(start, end - 1)
+        s.add(len(idx))
+        for condition, val in conditions:
+          idx = idx[cond_checker.mask(condition, val, idx)]
+          if len(idx) == 0:
             break
 
-        # If frames passed conditions
-        if frames and len(out) < self.num_batches_:
-          batch = Batch()
+        frames = [self.dataset_.get_prediction(i) for i in idx]
+
+      # If frames passed conditions
+      if frames and out < self.num_batches_:
+        batch = Batch()
+        if self.include_display_:
+          # img = get_image_data(self.path_, f.get_real_frame_number()+1)
+          imgs = get_images_data_from_video(self.path_ + self.filename_, [f.get_real_frame_number() for f in frames])
+          for f, (data, w, h) in zip(frames, render_predictions(frames, imgs)):
+            batch.add_frame(Frame(data, w, h, f))
+        else:
           for f in frames:
-            if self.include_display_:
-              # img = get_image_data(self.path_, f.get_real_frame_number()+1)
-              img = get_image_data_from_video(self.path_ + self.filename_, f.get_real_frame_number())
-              data, w, h = get_prediction_vis(f, img)
-              frame = Frame(data, w, h, f)
-            else:
-              frame = Frame(None, -1, -1, f)
-            batch.add_frame(frame)
-          out.append(batch)
-    return out
-
-def get_dataset_subset(dataset_json: dict, filename: str, tags: 'list[str]', num_batches: int, batch_size: int, include_display=False) -> tuple(['list[Batch]', dict]):
+            batch.add_frame(Frame(None, -1, -1, f))
+        out += 1
+        yield batch
+
+def get_dataset_subset(dataset: PoseStore, filename: str, tags: 'list[str]', num_batches: int, batch_size: int, include_display=False) -> tuple(['list[Batch]', dict]):
+  p = get_predicate(dataset, filename, tags, num_batches, batch_size, include_display)
+  if p is None: return
+  return p.run()
+
+def iter_dataset_subset(dataset: PoseStore, filename: str, tags: 'list[str]', num_batches: int, batch_size: int, include_display=False):
+  p = get_predicate(dataset, filename, tags, num_batches, batch_size, include_display)
+  if p is None: return
+  yield from p.iter_batches()
+
+def get_predicate(dataset: PoseStore, filename: str, tags: 'list[str]', num_batches: int, batch_size: int, include_display=False) -> Predicate:
   conditions = []
   sizes = list(map(float,tags[-2:]))
   for tag in tags[:-2]:
@@ -283,12 +272,66 @@ def get_dataset_subset(dataset_json: dict, filename: str, tags: 'list[str]', num
     conditions.pop(conditions.index(Condition.SPEED_FAST))
     conditions.pop(conditions.index(Condition.SPEED_SLOW))
 
-  p = Predicate(dataset_json, filename, conditions, num_batches, batch_size, include_display)
-  result = p.run()
-  return result
+  return Predicate(dataset, filename, conditions, num_batches, batch_size, include_display)
+
+def canonical_value(value):
+  # Integer and float thresholds of the same value describe the same assertion
+  if type(value) is int:
+    return float(value)
+  if type(value) is list:
+    return [canonical_value(v) for v in value]
+  return value
+
+def canonical_assertion(asst: dict) -> list:
+  return [asst.get('keypoints'), asst.get('type'), canonical_value(asst.get('attributes'))]
+
+def iter_assertion_errors(dataset: PoseStore, input: 'list[Batch]', assertions = 'list[dict]', workers=1, cache=None, scope=()):
+  # Yields (prediction ids, assertion names) of the errors as consecutive chunks of the input
+  # are checked. Errors come in prediction order, the assertions of a prediction in the
+  # order they were given. With a MaskCache, only assertions without a cached mask for the
+  # same scope (dataset and predicate filter) are evaluated.
+  a = AssertionChecker(dataset)
+  names = []
+  cached = {}
+  keys = {}
+  for asst in assertions:
+    assertion = Assertion(AssertionFunction(asst['keypoints'], asst['type'], asst['attributes']))
+    assertion.set_name('asst_{}'.format(len(names)+1))
+    names.append(assertion.name())
+    mask = None
+    if cache is not None:
+      keys[assertion.name()] = cache.key(list(scope), canonical_assertion(asst))
+      mask = cache.get(keys[assertion.name()], dataset)
+    if mask is None:
+      a.register_assertion(assertion)
+    else:
+      cached[assertion.name()] = mask
 
-def check_assertions(path: str, dataset_json: dict, input: 'list[Batch]', assertions = 'list[dict]', include_display=False) -> tuple([pd.DataFrame, 'list[Frame]']):
-  a = AssertionChecker(dataset_json)
+  idx = np.array([f.get_prediction().get_index() for b in input for f in b.get_frames()], dtype=np.int64)
+  if len(cached) == len(names):
+    chunks = iter([(0, {})])
+  else:
+    chunks = a.iter_evaluate(idx, workers)
+
+  computed = {name: [] for name in names if name not in cached}
+  end = 0
+  for start, masks in chunks:
+    with stage('collect') as s:
+      end = start + (len(next(iter(masks.values()))) if masks else len(idx))
+      for name, mask in masks.items():
+        computed[name].append(mask)
+      masks.update({name: mask[start:end] for name, mask in cached.items()})
+      rows, cols = np.nonzero(np.stack([masks[name] for name in names], axis=1))
+      s.add(len(rows))
+    yield idx[start + rows], [names[c] for c in cols]
+
+  # Masks are only stored once every chunk has been checked
+  if cache is not None and end == len(idx):
+    for name, pieces in computed.items():
+      cache.put(keys[name], dataset, np.concatenate(pieces + [np.zeros(0, dtype=bool)]))
+
+def check_assertions(path: str, dataset: PoseStore, input: 'list[Batch]', assertions = 'list[dict]', include_display=False, workers=1) -> tuple([pd.DataFrame, 'list[Frame]']):
+  a = AssertionChecker(dataset)
   for asst in assertions:
     a.register_assertion(Assertion(AssertionFunction(asst['keypoints'], asst['type'], asst['attributes'])))
 
@@ -297,8 +340,10 @@ def check_assertions(path: str, dataset_json: dict, input: 'list[Batch]', assert
     for f in b.get_frames():
       preds.append(f.get_prediction())
 
-  a.check(preds)
-  errors = a.retrieve_errors()
+  a.check(preds, workers)
+  with stage('retrieve_errors') as s:
+    errors = a.retrieve_errors()
+    s.add(0 if errors is None else len(errors))
 
   if errors is None:
     return None, None
@@ -308,12 +353,11 @@ def check_assertions(path: str, dataset_json: dict, input: 'list[Batch]', assert
     frame_num = errors.loc[:,'frame_number'].tolist()
     pred_idx = errors.loc[:,'prediction_idx'].tolist()
     
-    for ii, f in enumerate(frame_num):
-      # img = get_image_data(path, f+1)
-      img = get_image_data_from_video(path, f)
-      data, w, h = get_prediction_vis(preds[pred_idx[ii]], img)
-      frame = Frame(data, w, h, preds[pred_idx[ii]])
-      frames.append(frame)
+    # img = get_image_data(path, f+1)
+    imgs = get_images_data_from_video(path, frame_num)
+    error_preds = [preds[i] for i in pred_idx]
+    for p, (data, w, h) in zip(error_preds, render_predictions(error_preds, imgs)):
+      frames.append(Frame(data, w, h, p))
 
     return errors, frames
 
@@ -1,46 +1,154 @@
 import numpy as np
 import cv2
 import io
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
+import threading
+from collections import OrderedDict
+import itertools
+from concurrent.futures import ThreadPoolExecutor
 from data_utils import Prediction, PoseTrack_Keypoint_Pairs
 from PIL import Image
-from matplotlib import image
+from matplotlib import image, colors
 
-def get_image_data_from_video(path: str, frame: int) -> np.array:
-  cap = cv2.VideoCapture(path + '.mp4')
-  cap.set(cv2.CAP_PROP_POS_FRAMES, frame)
-  ret, f = cap.read()
-  if ret:
-      return f
-  else:
+DECODED_CACHE_BYTES = 512 << 20 # decoded frames kept in memory by the decoder pool
+MAX_SEQUENTIAL_GAP = 50 # frames decoded forward instead of seeking, seeks re-decode the whole GOP
+READ_CHUNK_FRAMES = 64
+RENDER_WORKERS = 8
+RENDER_FORMAT = '.png'
+BACKGROUND_ALPHA = 0.6
+LINE_WIDTH = 2
+
+# Endpoint1 , Endpoint2 , BGR line color
+BONE_COLORS = [(ind_1, ind_2, tuple(int(255*c) for c in reversed(colors.to_rgb(color))))
+               for ind_1, ind_2, color in PoseTrack_Keypoint_Pairs]
+
+class VideoDecoderPool:
+  # Keeps one open capture per video and an LRU of decoded frames bounded in bytes.
+  # Requested frames are decoded in increasing order so nearby frames are read
+  # sequentially instead of seeking for each one.
+  def __init__(self, max_bytes: int = DECODED_CACHE_BYTES, max_gap: int = MAX_SEQUENTIAL_GAP) -> None:
+    self.max_bytes_ = max_bytes
+    self.max_gap_ = max_gap
+    self.captures_ = {}
+    self.positions_ = {}
+    self.frames_ = OrderedDict()
+    self.bytes_ = 0
+    self.lock_ = threading.Lock()
+
+  def read(self, video: str, frame: int) -> np.array:
+    return self.read_many(video, [frame])[0]
+
+  def read_many(self, video: str, frames: 'list[int]') -> 'list[np.array]':
+    with self.lock_:
+      out = {}
+      for f in sorted(set(frames)):
+        key = (video, f)
+        if key in self.frames_:
+          self.frames_.move_to_end(key)
+          out[f] = self.frames_[key]
+        else:
+          out[f] = self.__decode(video, f)
+          self.__cache(key, out[f])
+
+      # Results are returned in the order they were requested
+      return [out[f] for f in frames]
+
+  def iread(self, video: str, frames: 'list[int]', chunk_size: int = READ_CHUNK_FRAMES):
+    # Same as read_many, but yields the frames chunk by chunk so only chunk_size
+    # decoded frames are held at once besides the cache
+    for i in range(0, len(frames), chunk_size):
+      yield from self.read_many(video, frames[i:i+chunk_size])
+
+  def release(self, video: str = None) -> None:
+    with self.lock_:
+      for v in ([video] if video else list(self.captures_.keys())):
+        if v in self.captures_:
+          self.captures_.pop(v).release()
+          self.positions_.pop(v)
+
+  def __decode(self, video: str, frame: int) -> np.array:
+    if video not in self.captures_:
+      self.captures_[video] = cv2.VideoCapture(video)
+      self.positions_[video] = 0
+
+    cap = self.captures_[video]
+    pos = self.positions_[video]
+    if frame < pos or frame - pos > self.max_gap_:
+      cap.set(cv2.CAP_PROP_POS_FRAMES, frame)
+      pos = frame
+
+    while pos < frame and cap.grab():
+      pos += 1
+
+    ret, f = cap.read()
+    if not ret:
+      # The capture position is unknown after a failed read, reopen it next time
+      self.captures_.pop(video).release()
+      self.positions_.pop(video)
       raise RuntimeError('No frame obtained.')
 
+    self.positions_[video] = pos + 1
+
+    # Cached frames are shared between callers
+    f.flags.writeable = False
+    return f
+
+  def __cache(self, key: tuple, frame: np.array) -> None:
+    self.frames_[key] = frame
+    self.bytes_ += frame.nbytes
+    while self.bytes_ > self.max_bytes_ and len(self.frames_) > 1:
+      _, evicted = self.frames_.popitem(last=False)
+      self.bytes_ -= evicted.nbytes
+
+decoder_pool = VideoDecoderPool()
+
+def get_image_data_from_video(path: str, frame: int) -> np.array:
+  return decoder_pool.read(path + '.mp4', frame)
+
+def get_images_data_from_video(path: str, frames: 'list[int]'):
+  return decoder_pool.iread(path + '.mp4', frames)
+
 def get_image_data(path: str, frame: int) -> np.array:
   img_path = path + '/frames/thumb' + '{0:04d}'.format(frame+1) + '.png'
   img = image.imread(img_path)
   return np.asarray(img)
 
-def get_prediction_vis(pred: Prediction, image: np.array) -> tuple([io.BytesIO,int,int]):
+def render_prediction(pred: Prediction, image: np.array, ext: str = RENDER_FORMAT) -> tuple([io.BytesIO,int,int]):
+  # Draws the skeleton on the bbox crop of a BGR frame and encodes it in-process. It does
+  # not touch any global state, so it can be called from several threads at once.
   keypoints = pred.get_keypoints()
   x,y,w,h = list(map(int, pred.get_bbox()))
-  
-  plt.imshow(cv2.cvtColor(image[y:y+h,x:x+w,:], cv2.COLOR_BGR2RGB),alpha=0.6)
-  fig = plt.gcf()
-  #plt.imshow(image[y:y+h,x:x+w,:],alpha=0.6)
+  x, y = max(x, 0), max(y, 0)
+
+  # Crop blended over a white background, as the former alpha=0.6 matplotlib overlay
+  crop = image[y:y+h,x:x+w,:]
+  if crop.size == 0:
+    # Bounding box outside the frame
+    crop = np.zeros((max(h, 1), max(w, 1), 3), dtype=np.uint8)
+  out = cv2.addWeighted(crop, BACKGROUND_ALPHA, np.full_like(crop, 255), 1 - BACKGROUND_ALPHA, 0)
 
-  for joint_pair in PoseTrack_Keypoint_Pairs:
-    ind_1, ind_2, color = joint_pair
+  for ind_1, ind_2, color in BONE_COLORS:
     x1, y1 = keypoints[ind_1].position()
     x2, y2 = keypoints[ind_2].position()
-            
-    plt.plot([x1-x, x2-x], [y1-y, y2-y], c=color, linewidth=2)
+    cv2.line(out, (int(x1-x), int(y1-y)), (int(x2-x), int(y2-y)), color, LINE_WIDTH, cv2.LINE_AA)
 
-  b = io.BytesIO()
-  plt.savefig(b, bbox_inches='tight', format='png',dpi=100)
-  plt.close(fig)
+  ok, buf = cv2.imencode(ext, out)
+  if not ok:
+    raise RuntimeError('Could not encode image as ' + ext)
 
-  w, h = plt.gcf().get_size_inches()
+  return io.BytesIO(buf.tobytes()), out.shape[1], out.shape[0]
 
-  return b, w * 100, h*100
+def render_predictions(preds: 'list[Prediction]', images, ext: str = RENDER_FORMAT, workers: int = RENDER_WORKERS) -> 'list[tuple([io.BytesIO,int,int])]':
+  # images can be a generator (see get_images_data_from_video); it is consumed
+  # READ_CHUNK_FRAMES at a time so decoding and rendering memory stay bounded
+  out = []
+  pairs = zip(preds, images)
+  with ThreadPoolExecutor(max_workers=workers) as pool:
+    while True:
+      chunk = list(itertools.islice(pairs, READ_CHUNK_FRAMES))
+      if not chunk:
+        break
+      out.extend(pool.map(lambda pi: render_prediction(pi[0], pi[1], ext), chunk))
+  return out
+
+def get_prediction_vis(pred: Prediction, image: np.array) -> tuple([io.BytesIO,int,int]):
+  return render_prediction(pred, image)